@@ -1,38 +1,401 @@
+import argparse
+import csv
+import functools
+import glob
+import hashlib
 import os
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import requests
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from urllib.parse import quote, unquote, urlsplit
+import json
+import math
+import random
+import re
 import socket
+import sqlite3
+import sys
+import threading
 import time
 
+REQUIRED_CONFIG_KEYS = ['SERVICE_ACCOUNT_FILE', 'KM_SPREADSHEET_ID', 'TAX_SPREADSHEET_ID',
+                        'API_TOKEN', 'HUBSPOT_API_KEY']
+CONFIG_INTEGERS = ['KM_FINGERPRINT_TTL', 'QUOTE_SERVER_PORT', 'CACHE_MAX_ENTRIES']
+CONFIG_CHOICES = {'TAX_ENGINE': ('sheet', 'local'), 'CO2_ENGINE': ('sheet', 'local')}
+
+
 def load_config():
+    # Læses én gang ved start og valideres, så fejl i config.txt opdages før første tilbud
     try:
         with open('config.txt', 'r', encoding='utf-8') as file:
             config = {}
             for line in file:
-                if '=' in line:
-                    key, value = line.strip().split('=')
+                line = line.strip()
+                if '=' in line and not line.startswith('#'):
+                    key, value = line.split('=', 1)
                     config[key.strip()] = value.strip()
-            return config
     except FileNotFoundError:
         raise Exception("config.txt fil ikke fundet i samme mappe som scriptet")
 
+    missing = [key for key in REQUIRED_CONFIG_KEYS if not config.get(key)]
+    if missing:
+        raise Exception(f"config.txt mangler: {', '.join(missing)}")
+    for key in CONFIG_INTEGERS:
+        if key in config:
+            try:
+                config[key] = int(config[key])
+            except ValueError:
+                raise Exception(f"{key} i config.txt skal være et heltal")
+    for key, choices in CONFIG_CHOICES.items():
+        if key in config and config[key] not in choices:
+            raise Exception(f"{key} i config.txt skal være en af: {', '.join(choices)}")
+    return config
+
+
+# Tidsmåling pr. trin. Et tilbud samler sine målinger i et metrics-objekt, som følger
+# med til de tråde der arbejder for tilbuddet (fx prefetch).
+METRICS_WINDOW = 500  # antal seneste målinger pr. trin i metrics-filen
+
+_metrics_context = threading.local()
+_metrics_file_lock = threading.Lock()
+
+
+def start_quote_metrics():
+    metrics = {'stages': [], 'lock': threading.Lock(), 'input_wait': 0.0}
+    _metrics_context.metrics = metrics
+    _metrics_context.stack = []
+    return metrics
+
+
+def timed_input(prompt, metrics):
+    # Tid hvor operatøren taster tæller ikke med i tilbuddets samlede tid
+    started = time.perf_counter()
+    try:
+        return input(prompt)
+    finally:
+        metrics['input_wait'] += time.perf_counter() - started
+
+
+def with_quote_metrics(metrics, func):
+    def run(*args, **kwargs):
+        _metrics_context.metrics = metrics
+        _metrics_context.stack = []
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _metrics_context.metrics = None
+    return run
+
+
+def instrumented(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = getattr(_metrics_context, 'metrics', None)
+            if metrics is None:
+                return func(*args, **kwargs)
+
+            record = {'stage': stage, 'seconds': 0.0, 'retries': 0, 'bytes': 0}
+            _metrics_context.stack.append(record)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record['seconds'] = time.perf_counter() - started
+                _metrics_context.stack.pop()
+                with metrics['lock']:
+                    metrics['stages'].append(record)
+        return wrapper
+    return decorator
+
+
+def current_stage_record():
+    stack = getattr(_metrics_context, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def record_stage_retry():
+    record = current_stage_record()
+    if record is not None:
+        record['retries'] += 1
+
+
+def record_stage_bytes(size):
+    record = current_stage_record()
+    if record is not None:
+        record['bytes'] += size
+
+
+def finish_quote_metrics(metrics, started):
+    # Afslutter målingen for et tilbud: samlet tid (uden ventetid ved input) tilføjes og det
+    # rullende vindue opdateres
+    total = time.perf_counter() - started - metrics['input_wait']
+    with metrics['lock']:
+        metrics['stages'].append({'stage': 'tilbud_total', 'seconds': total, 'retries': 0, 'bytes': 0})
+    try:
+        update_metrics_file(metrics)
+    except OSError as e:
+        print(f"Kunne ikke gemme målinger: {e}")
+    timings = {stage: round(values['seconds'], 3) for stage, values in summarize_quote_metrics(metrics).items()}
+    timings['total'] = timings.pop('tilbud_total')
+    return timings
+
+
+def summarize_quote_metrics(metrics):
+    summary = {}
+    with metrics['lock']:
+        records = list(metrics['stages'])
+    for record in records:
+        stage = summary.setdefault(record['stage'], {'seconds': 0.0, 'calls': 0, 'retries': 0, 'bytes': 0})
+        stage['seconds'] += record['seconds']
+        stage['calls'] += 1
+        stage['retries'] += record['retries']
+        stage['bytes'] += record['bytes']
+    return summary
+
+
+def format_quote_metrics(metrics):
+    lines = [f"{'Trin':<16}{'Tid (s)':>10}{'Kald':>6}{'Retries':>9}{'Bytes':>10}"]
+    summary = summarize_quote_metrics(metrics)
+    for stage, values in sorted(summary.items(), key=lambda item: item[1]['seconds'], reverse=True):
+        lines.append(f"{stage:<16}{values['seconds']:>10.3f}{values['calls']:>6}"
+                     f"{values['retries']:>9}{values['bytes']:>10}")
+    return "\n".join(lines)
+
+
+def update_metrics_file(metrics):
+    # Rullende vindue med de seneste målinger pr. trin til p50/p95-rapporten
+    with metrics['lock']:
+        records = list(metrics['stages'])
+    with _metrics_file_lock:
+        try:
+            with open(METRICS_FILE, 'r', encoding='utf-8') as file:
+                samples = json.load(file)
+        except (FileNotFoundError, ValueError):
+            samples = {}
+        for record in records:
+            stage_samples = samples.setdefault(record['stage'], [])
+            stage_samples.append(round(record['seconds'], 4))
+            del stage_samples[:-METRICS_WINDOW]
+
+        os.makedirs(os.path.dirname(METRICS_FILE) or '.', exist_ok=True)
+        temp_file = METRICS_FILE + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump(samples, file)
+        os.replace(temp_file, METRICS_FILE)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def report_metrics():
+    try:
+        with open(METRICS_FILE, 'r', encoding='utf-8') as file:
+            samples = json.load(file)
+    except FileNotFoundError:
+        print("Ingen målinger endnu")
+        return
+
+    print(f"{'Trin':<16}{'Antal':>7}{'p50 (s)':>10}{'p95 (s)':>10}")
+    for stage, values in sorted(samples.items()):
+        values = sorted(values)
+        if values:
+            print(f"{stage:<16}{len(values):>7}{percentile(values, 0.5):>10.3f}{percentile(values, 0.95):>10.3f}")
+
+
+def run_profiled(func):
+    # Kører hele sessionen under cProfile og gemmer resultatet til senere analyse
+    import cProfile
+    import pstats
+    profile_file = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.prof"
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(profile_file)
+        print(f"\nProfil gemt i {profile_file}")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+
+# Fælles HTTP-klient: én pooled session pr. host, standard timeouts og retry.
+# API-adresserne og grænserne pr. host står sammen med resten af konfigurationen.
+HTTP_TIMEOUT = (5, 30)  # (connect, read) i sekunder
+HTTP_MAX_ATTEMPTS = 4
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 30
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+# Antal API-kald i det aktuelle tilbud, pr. host/tjeneste
+_api_call_counts = Counter()
+_api_call_counts_lock = threading.Lock()
+
+
+def count_api_call(name):
+    with _api_call_counts_lock:
+        _api_call_counts[name] += 1
+
+
+def reset_api_call_counts():
+    with _api_call_counts_lock:
+        _api_call_counts.clear()
+
+
+def get_api_call_counts():
+    with _api_call_counts_lock:
+        return dict(_api_call_counts)
+
+
+def format_api_call_counts():
+    counts = get_api_call_counts()
+    details = ", ".join(f"{name}: {count}" for name, count in sorted(counts.items()))
+    return f"{sum(counts.values())} ({details})" if counts else "0"
+
+
+_rate_limit_next = {}
+_rate_limit_lock = threading.Lock()
+
+
+def wait_for_rate_limit(host):
+    limit = HOST_RATE_LIMITS.get(host)
+    with _rate_limit_lock:
+        now = time.monotonic()
+        slot = max(now, _rate_limit_next.get(host, 0))
+        if limit:
+            _rate_limit_next[host] = slot + 1 / limit
+    time.sleep(max(0, slot - now))
+
+
+def pause_rate_limit(host, seconds):
+    # Et 429-svar gælder alle tråde der kalder samme host, ikke kun den der fik svaret
+    with _rate_limit_lock:
+        _rate_limit_next[host] = max(_rate_limit_next.get(host, 0), time.monotonic() + seconds)
+
+
+def get_http_session(url):
+    host = urlsplit(url).netloc
+    with _http_sessions_lock:
+        session = _http_sessions.get(host)
+        if session is None:
+            # requests importeres først når der skal kaldes et API, så opstarten ikke venter på det
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[host] = session
+        return session
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None):
+    delay = parse_retry_after(retry_after)
+    if delay is not None:
+        return min(delay, HTTP_BACKOFF_MAX)
+    # Eksponentiel backoff med fuld jitter
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+def http_request(method, url, timeout=HTTP_TIMEOUT, max_attempts=HTTP_MAX_ATTEMPTS, **kwargs):
+    import requests
+    session = get_http_session(url)
+    for attempt in range(max_attempts):
+        try:
+            wait_for_rate_limit(urlsplit(url).netloc)
+            count_api_call(urlsplit(url).netloc)
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt < max_attempts - 1:
+                record_stage_retry()
+                time.sleep(retry_delay(attempt))
+                continue
+            raise
+
+        if response.status_code in RETRY_STATUS_CODES and attempt < max_attempts - 1:
+            record_stage_retry()
+            delay = retry_delay(attempt, response.headers.get('Retry-After'))
+            if response.status_code == 429:
+                pause_rate_limit(urlsplit(url).netloc, delay)
+            else:
+                time.sleep(delay)
+            continue
+        record_stage_bytes(len(response.content))
+        return response
+
+
+def is_retryable_error(error):
+    # HttpError fra googleapiclient har status på resp
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is not None:
+        return int(status) in RETRY_STATUS_CODES
+    if isinstance(error, socket.error):
+        return True
+    # httplib2 er kun importeret hvis der er lavet Sheets-kald
+    import httplib2
+    return isinstance(error, httplib2.HttpLib2Error)
+
+
+def call_with_retry(func, max_attempts=HTTP_MAX_ATTEMPTS):
+    for attempt in range(max_attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_attempts - 1 or not is_retryable_error(e):
+                raise
+            resp = getattr(e, 'resp', None)
+            retry_after = resp.get('retry-after') if hasattr(resp, 'get') else None
+            record_stage_retry()
+            time.sleep(retry_delay(attempt, retry_after))
+
+
+UPDATE_TIMEOUT = (2, 5)  # kort timeout; opdateringen må aldrig forsinke opstarten
+
 
 def update_from_github():
+    # Den kørende proces har allerede indlæst scriptet, så en ny version lægges blot
+    # på plads og bruges fra næste start
+    if not UPDATE_URL:
+        return
     try:
-        import requests
-        raw_url = "https://raw.githubusercontent.com/vr-autobasen/ABExportBeregner/refs/heads/main/ExportCalc_inkl_van.py"
-        response = requests.get(raw_url)
-
-        if response.status_code == 200:
-            with open(__file__, 'w', encoding='utf-8') as file:
-                file.write(response.text)
-            print("Script opdateret fra GitHub - henter km stand fra hubben inkl EUR beregner fra dagskurs")
-        else:
-            print(f"Kunne ikke hente opdateringer. Status kode: {response.status_code}")
-    except Exception as e:
-        print(f"Fejl ved opdatering: {e}")
+        response = http_request('GET', UPDATE_URL, timeout=UPDATE_TIMEOUT, max_attempts=1)
+        if response.status_code != 200:
+            return
+        with open(__file__, 'r', encoding='utf-8') as file:
+            if file.read() == response.text:
+                return
+        # En afbrudt eller ødelagt download må ikke erstatte et fungerende script
+        compile(response.text, __file__, 'exec')
+        update_file = __file__ + '.update'
+        with open(update_file, 'w', encoding='utf-8') as file:
+            file.write(response.text)
+        os.replace(update_file, __file__)
+        print("\nNy version hentet fra GitHub - bruges ved næste start")
+    except Exception:
+        # Uden net eller med en fejlende download køres den nuværende version videre
+        pass
+
+
+def start_update_check():
+    threading.Thread(target=update_from_github, daemon=True).start()
 
 
 # Google Sheets setup
@@ -41,41 +404,380 @@ config = load_config()
 SERVICE_ACCOUNT_FILE = config['SERVICE_ACCOUNT_FILE']
 KM_SPREADSHEET_ID = config['KM_SPREADSHEET_ID']
 TAX_SPREADSHEET_ID = config['TAX_SPREADSHEET_ID']
+# 'sheet' (standard) eller 'local' for den lokale afgiftsberegning
+TAX_ENGINE = config.get('TAX_ENGINE', 'sheet')
+# 'sheet' (standard) eller 'local' for den lokale CO2-omregning
+CO2_ENGINE = config.get('CO2_ENGINE', 'sheet')
+# Arkene bruges som fælles regnemaskine: input skrives og resultatet læses bagefter,
+# så hele skriv-og-læs-forløbet skal have arket for sig selv
+SPREADSHEET_LOCKS = {
+    KM_SPREADSHEET_ID: threading.RLock(),
+    TAX_SPREADSHEET_ID: threading.RLock()
+}
+CACHE_FILE = config.get('CACHE_FILE', 'cache.sqlite3')
+UPDATE_URL = config.get(
+    'UPDATE_URL',
+    "https://raw.githubusercontent.com/vr-autobasen/ABExportBeregner/refs/heads/main/ExportCalc_inkl_van.py")
+# Varm tilstand mellem kørsler der ikke ligger i cachen (Sheets-token)
+WARM_STATE_FILE = config.get('WARM_STATE_FILE', 'warm_state.json')
+# Fingeraftryk af KM-arkets formler indgår i cachenøglen for handelspris-rækken, så
+# cachen ugyldiggøres når nogen retter arket. Standardområdet dækker kun Ark1; ligger der
+# opslagstabeller på andre faner, tilføjes de kommasepareret (fx 'Ark1!A1:Z100,Tabeller!A1:H60').
+# Første område skal starte i A1, så inputcellerne E7:E9 kan udelades.
+KM_FINGERPRINT_RANGES = [part.strip() for part in
+                         config.get('KM_FINGERPRINT_RANGE', 'Ark1!A1:Z100').split(',') if part.strip()]
+# Sekunder et fingeraftryk genbruges; så længe kan en rettelse i arket gå upåagtet hen.
+# --refresh læser altid arket igen.
+KM_FINGERPRINT_TTL = config.get('KM_FINGERPRINT_TTL', 30)
+KM_INPUT_CELLS = {(6, 4), (7, 4), (8, 4)}  # E7:E9 som (række, kolonne) fra A1
+# Sættes QUOTE_SERVER_URL (fx http://127.0.0.1:8765) beregner CLI'en via den fælles tilbudsserver
+QUOTE_SERVER_URL = config.get('QUOTE_SERVER_URL', '').rstrip('/')
+QUOTE_SERVER_HOST = config.get('QUOTE_SERVER_HOST', '127.0.0.1')
+QUOTE_SERVER_PORT = config.get('QUOTE_SERVER_PORT', 8765)
+QUOTE_LOG_FILE = config.get('QUOTE_LOG_FILE', 'logs/quotes.sqlite3')
+METRICS_FILE = config.get('METRICS_FILE', 'logs/metrics.json')
+CACHE_MAX_ENTRIES = config.get('CACHE_MAX_ENTRIES', 5000)
+# API-adresserne kan peges mod lokale stand-ins, fx i bench_exportcalc.py
+SYNSBASEN_BASE_URL = config.get('SYNSBASEN_BASE_URL', 'https://api.synsbasen.dk').rstrip('/')
+HUBSPOT_BASE_URL = config.get('HUBSPOT_BASE_URL', 'https://api.hubapi.com').rstrip('/')
+FX_BASE_URL = config.get('FX_BASE_URL', 'https://api.exchangerates.org.uk').rstrip('/')
+# Maks. antal kald pr. sekund pr. host, så parallelle kørsler holder sig under API-grænserne
+HOST_RATE_LIMITS = {
+    urlsplit(SYNSBASEN_BASE_URL).netloc: 5,
+    urlsplit(HUBSPOT_BASE_URL).netloc: 4
+}
+
+
+
+# Sheets-klienten bygges én gang pr. proces. Google-bibliotekerne importeres
+# først ved det første Sheets-kald, så opstart og 'q' ikke betaler for dem.
+_sheets_credentials = None
+_sheets_service = None
+_sheets_service_lock = threading.Lock()
+_sheets_http = threading.local()
+# Sat når en anden Sheets-implementering er installeret (fx benchmarkens lokale ark)
+_sheets_offline = False
+
+
+def install_sheets_service(service):
+    global _sheets_service, _sheets_offline
+    with _sheets_service_lock:
+        _sheets_service = service
+        _sheets_offline = True
+
+
+def get_sheets_credentials():
+    global _sheets_credentials
+    with _sheets_service_lock:
+        if _sheets_credentials is None:
+            from google.oauth2 import service_account
+            # Token hentes først ved første kald og fornyes automatisk når det udløber
+            _sheets_credentials = service_account.Credentials.from_service_account_file(
+                SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+            restore_sheets_token(_sheets_credentials)
+        return _sheets_credentials
 
 
+def load_warm_state():
+    try:
+        with open(WARM_STATE_FILE, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
 
-def get_sheets_service():
-    max_attempts = 3
-    for attempt in range(max_attempts):
-        try:
-            creds = service_account.Credentials.from_service_account_file(
-                SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-            service = build('sheets', 'v4', credentials=creds)
-            return service.spreadsheets()
-        except socket.error:
-            if attempt < max_attempts - 1:
-                time.sleep(2 ** attempt)
-                continue
-            raise
 
+def save_warm_state(state):
+    # Filen indeholder et adgangstoken, så kun brugeren selv må læse den
+    update_file = WARM_STATE_FILE + '.tmp'
+    with os.fdopen(os.open(update_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as file:
+        json.dump(state, file)
+    os.replace(update_file, WARM_STATE_FILE)
 
-def get_eur_exchange_rate():
-    url = "https://api.exchangerates.org.uk/latest"
+
+def restore_sheets_token(credentials):
+    # Et gemt token der stadig er gyldigt sparer token-kaldet til Google ved opstart
+    token = load_warm_state().get('sheets_token')
+    if not token:
+        return
+    try:
+        expiry = datetime.fromisoformat(token['expiry'])
+        # google-auth bruger naive UTC-tidspunkter
+        valid = (expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds() > 60
+        if valid:
+            credentials.token = token['token']
+            credentials.expiry = expiry
+    except (KeyError, TypeError, ValueError):
+        # Ødelagt snapshot: ignoreres, så der hentes et nyt token som normalt
+        return
+
+
+def store_sheets_token(credentials):
+    if not credentials.token or not credentials.expiry:
+        return
+    state = load_warm_state()
+    state['sheets_token'] = {'token': credentials.token, 'expiry': credentials.expiry.isoformat()}
+    try:
+        save_warm_state(state)
+    except OSError:
+        pass
+
+
+def get_sheets_http():
+    # httplib2 er ikke trådsikker, så hver tråd får sin egen forbindelse
+    if _sheets_offline:
+        return None
+    http = getattr(_sheets_http, 'http', None)
+    if http is None:
+        import google_auth_httplib2
+        import httplib2
+        # Timeout så et hængende Sheets-kald ikke blokerer hele løkken
+        http = google_auth_httplib2.AuthorizedHttp(
+            get_sheets_credentials(), http=httplib2.Http(timeout=HTTP_TIMEOUT[1]))
+        _sheets_http.http = http
+    return http
+
+
+def get_sheets_service():
+    global _sheets_service
+    if _sheets_service is not None:
+        return _sheets_service
+
+    http = get_sheets_http()
+    with _sheets_service_lock:
+        if _sheets_service is None:
+            from googleapiclient.discovery import build
+            # Brug det medfølgende discovery-dokument i stedet for at hente og parse det hver gang
+            service = build('sheets', 'v4', http=http, static_discovery=True, cache_discovery=False)
+            _sheets_service = service.spreadsheets()
+        return _sheets_service
+
+
+@instrumented('sheets_klient')
+def warm_sheets_service():
+    # Byg klienten og hent et token på forhånd, så første Sheets-kald ikke venter på det
+    service = get_sheets_service()
+    if _sheets_offline:
+        return service
+    credentials = get_sheets_credentials()
+    if not credentials.valid:
+        import google_auth_httplib2
+        import httplib2
+        credentials.refresh(google_auth_httplib2.Request(httplib2.Http(timeout=HTTP_TIMEOUT[1])))
+        store_sheets_token(credentials)
+    return service
+
+
+@instrumented('sheets_skriv')
+def sheets_batch_update(sheets, spreadsheet_id, updates):
+    body = {'valueInputOption': 'USER_ENTERED', 'data': updates}
+    request = sheets.values().batchUpdate(spreadsheetId=spreadsheet_id, body=body)
+
+    def execute():
+        count_api_call('sheets')
+        return request.execute(http=get_sheets_http())
+
+    result = call_with_retry(execute)
+    record_stage_bytes(len(json.dumps(body)))
+    return result
+
+
+@instrumented('sheets_læs')
+def sheets_batch_get(sheets, spreadsheet_id, ranges, value_render_option='FORMATTED_VALUE'):
+    request = sheets.values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges,
+                                       valueRenderOption=value_render_option)
+
+    def execute():
+        count_api_call('sheets')
+        return request.execute(http=get_sheets_http())
+
+    result = call_with_retry(execute)
+    record_stage_bytes(len(json.dumps(result)))
+    # Tomme områder returneres uden 'values'
+    return [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+
+# Persistent cache for opslag pr. nummerplade. Køretøjsdata ændrer sig stort set
+# aldrig, mens vurderinger og kilometertal fra HubSpot hurtigt bliver forældede.
+CACHE_TTLS = {
+    'vehicle': 30 * 24 * 3600,
+    'appraisals': 24 * 3600,
+    'hubspot_mileage': 3600,
+    # Kursen gemmes længe, så den kan bruges som reserve når API'et er nede
+    'fx_rate': 30 * 24 * 3600,
+    # Handelspris-rækken er gyldig så længe KM-arkets formler er uændrede
+    'trade_row': 30 * 24 * 3600,
+    'km_fingerprint': KM_FINGERPRINT_TTL
+}
+
+# 'normal', 'refresh' (hent altid, men gem resultatet) eller 'off'
+_cache_mode = 'normal'
+_cache_connection = None
+_cache_lock = threading.Lock()
+_cache_stats = Counter()
+
+
+def set_cache_mode(mode):
+    global _cache_mode
+    _cache_mode = mode
+
+
+def normalize_registration_number(registration_number):
+    return re.sub(r'[\s-]', '', registration_number).upper()
+
+
+def get_cache_connection():
+    global _cache_connection
+    if _cache_connection is None:
+        _cache_connection = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+        _cache_connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "source TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "stored_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (source, key))"
+        )
+        _cache_connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+        _cache_connection.commit()
+    return _cache_connection
+
+
+def cache_get(source, key):
+    # Returnerer (fundet, værdi), så None kan caches som en gyldig værdi
+    if _cache_mode != 'normal':
+        with _cache_lock:
+            _cache_stats[f'{source}_miss'] += 1
+        return False, None
+
+    now = time.time()
+    with _cache_lock:
+        connection = get_cache_connection()
+        row = connection.execute(
+            "SELECT value, stored_at FROM cache WHERE source = ? AND key = ?", (source, key)
+        ).fetchone()
+        if row is None or now - row[1] > CACHE_TTLS[source]:
+            if row is not None:
+                connection.execute("DELETE FROM cache WHERE source = ? AND key = ?", (source, key))
+                connection.commit()
+            _cache_stats[f'{source}_miss'] += 1
+            return False, None
+
+        connection.execute(
+            "UPDATE cache SET accessed_at = ? WHERE source = ? AND key = ?", (now, source, key))
+        connection.commit()
+        _cache_stats[f'{source}_hit'] += 1
+        return True, json.loads(row[0])
+
+
+def cache_set(source, key, value):
+    if _cache_mode == 'off':
+        return
+
+    now = time.time()
+    with _cache_lock:
+        connection = get_cache_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (source, key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (source, key, json.dumps(value), now, now)
+        )
+        # LRU: fjern de mindst brugte poster når cachen er fuld
+        connection.execute(
+            "DELETE FROM cache WHERE rowid IN ("
+            "SELECT rowid FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (CACHE_MAX_ENTRIES,)
+        )
+        connection.commit()
+
+
+def format_cache_stats():
+    hits = sum(count for name, count in _cache_stats.items() if name.endswith('_hit'))
+    misses = sum(count for name, count in _cache_stats.items() if name.endswith('_miss'))
+    return f"{hits} hits, {misses} misses"
+
+
+FALLBACK_EUR_RATE = 7.4602  # Aktuel standardkurs
+
+_fx_refresh_lock = threading.Lock()
+_fx_refresh_thread = None
+
+
+@instrumented('valutakurs_api')
+def fetch_eur_exchange_rate():
+    url = f"{FX_BASE_URL}/latest"
     headers = {
         "Content-Type": "application/json"
     }
 
+    response = http_request('GET', url, headers=headers)
+    response.raise_for_status()
+    rate = {
+        'rate': float(response.json()['rates']['DKK']),
+        'date': datetime.now().strftime('%Y-%m-%d'),
+        'fetched_at': datetime.now().isoformat(timespec='seconds')
+    }
+    cache_set('fx_rate', 'EUR/DKK', rate)
+    return rate
+
+
+def refresh_eur_exchange_rate_in_background():
+    global _fx_refresh_thread
+
+    def refresh():
+        found, cached = cache_get('fx_rate', 'EUR/DKK')
+        if found and cached['date'] == datetime.now().strftime('%Y-%m-%d'):
+            return
+        try:
+            fetch_eur_exchange_rate()
+        except Exception:
+            # Den gamle kurs bruges videre til næste forsøg
+            pass
+
+    with _fx_refresh_lock:
+        if _fx_refresh_thread is None or not _fx_refresh_thread.is_alive():
+            _fx_refresh_thread = threading.Thread(target=refresh, daemon=True)
+            _fx_refresh_thread.start()
+
+
+@instrumented('valutakurs')
+def get_eur_exchange_rate():
+    # Dagens kurs fra cachen; en ældre kurs bruges mens en ny hentes i baggrunden
+    found, cached = cache_get('fx_rate', 'EUR/DKK')
+    if found:
+        if cached['date'] != datetime.now().strftime('%Y-%m-%d'):
+            refresh_eur_exchange_rate_in_background()
+        return {'rate': cached['rate'], 'source': 'cached', 'fetched_at': cached['fetched_at']}
+
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        return float(response.json()['rates']['DKK'])
-    except Exception as e:
-        # Hvis API'et fejler, brug en standard kurs
-        return 7.4602  # Aktuel standardkurs
+        rate = fetch_eur_exchange_rate()
+        return {'rate': rate['rate'], 'source': 'live', 'fetched_at': rate['fetched_at']}
+    except Exception:
+        # Hvis API'et fejler og der ikke er en gemt kurs, brug standardkursen
+        return {'rate': FALLBACK_EUR_RATE, 'source': 'fallback', 'fetched_at': None}
+
+
+def get_todays_eur_exchange_rate():
+    # Til genberegning og prisscenarier, hvor gårsdagens kurs giver et forkert resultat: en kurs
+    # fra en tidligere dag hentes med det samme, og den gemte bruges kun hvis API'et fejler
+    found, cached = cache_get('fx_rate', 'EUR/DKK')
+    if found and cached['date'] == datetime.now().strftime('%Y-%m-%d'):
+        return {'rate': cached['rate'], 'source': 'cached', 'fetched_at': cached['fetched_at']}
+
+    try:
+        rate = fetch_eur_exchange_rate()
+        return {'rate': rate['rate'], 'source': 'live', 'fetched_at': rate['fetched_at']}
+    except Exception:
+        if found:
+            return {'rate': cached['rate'], 'source': 'cached', 'fetched_at': cached['fetched_at']}
+        return {'rate': FALLBACK_EUR_RATE, 'source': 'fallback', 'fetched_at': None}
+
 
+def format_exchange_rate(exchange_rate):
+    if exchange_rate['fetched_at']:
+        return f"{exchange_rate['rate']:.4f} ({exchange_rate['source']}, {exchange_rate['fetched_at']})"
+    return f"{exchange_rate['rate']:.4f} ({exchange_rate['source']})"
 
+
+@instrumented('hubspot')
 def fetch_hubspot_mileage(registration_number, api_key):
-    url = "https://api.hubapi.com/crm/v3/objects/deals/search"
+    url = f"{HUBSPOT_BASE_URL}/crm/v3/objects/deals/search"
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -98,7 +800,7 @@ def fetch_hubspot_mileage(registration_number, api_key):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = http_request('POST', url, headers=headers, json=payload)
         response.raise_for_status()
 
         deals = response.json().get("results", [])
@@ -110,129 +812,335 @@ def fetch_hubspot_mileage(registration_number, api_key):
         return None
 
 
-def fetch_basic_vehicle_data(registration_number, api_token):
-    url = f"https://api.synsbasen.dk/v1/vehicles/registration/{registration_number}"
-    headers = {
-        "Authorization": f"Bearer {api_token}",
-        "Content-Type": "application/json"
-    }
+HUBSPOT_SEARCH_MAX_GROUPS = 5  # HubSpot tillader maks. 5 filterGroups (OR) pr. søgning
+HUBSPOT_SEARCH_PAGE_SIZE = 100
 
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
 
-        data = response.json()["data"]
-        return {
-            'fuel_efficiency': data.get('fuel_efficiency'),
-            'fuel_type': data.get('fuel_type'),
-            'registration_date': data.get('first_registration_date'),
-            'model': data.get('model'),
-            'version': data.get('version'),
-            'brand': data.get('brand'),
-            'type': data.get('kind'),
-            'total_weight': data.get('total_weight')
-        }
-    except Exception as e:
-        raise Exception(f"Fejl ved hentning af køretøjsdata: {str(e)}")
+def find_deal_plate(dealname, registration_numbers):
+    tokens = set(re.findall(r'[A-Z0-9ÆØÅ]+', str(dealname or '').upper()))
+    for registration_number in registration_numbers:
+        if registration_number in tokens:
+            return registration_number
+    return None
 
 
-def fetch_engine_data(registration_number, api_token):
-    url = "https://api.synsbasen.dk/v1/vehicles"
+@instrumented('hubspot')
+def fetch_hubspot_mileages(registration_numbers, api_key):
+    # Kilometertal for mange nummerplader: én søgning pr. 5 plader i stedet for én pr. plade.
+    # Returnerer {nummerplade: kilometertal} fra den nyeste deal (createdate) pr. plade, og None
+    # for plader uden deal. Plader fra en søgning der fejlede er ikke med.
+    url = f"{HUBSPOT_BASE_URL}/crm/v3/objects/deals/search"
     headers = {
-        "Authorization": f"Bearer {api_token}",
+        "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
-    params = {
-        "query": {
-            "registration_start": registration_number
-        },
-        "method": "SELECT",
-        "expand[]": "engine"
-    }
+    plates = sorted({normalize_registration_number(plate) for plate in registration_numbers if plate})
+    newest = {}
+    answered = []
+
+    for start in range(0, len(plates), HUBSPOT_SEARCH_MAX_GROUPS):
+        chunk = plates[start:start + HUBSPOT_SEARCH_MAX_GROUPS]
+        payload = {
+            "filterGroups": [{
+                "filters": [{
+                    "propertyName": "dealname",
+                    "operator": "CONTAINS_TOKEN",
+                    "value": plate
+                }]
+            } for plate in chunk],
+            "properties": ["dealname", "kilometer", "createdate"],
+            "sorts": [{
+                "propertyName": "createdate",
+                "direction": "DESCENDING"
+            }],
+            "limit": HUBSPOT_SEARCH_PAGE_SIZE
+        }
+        try:
+            while True:
+                response = http_request('POST', url, headers=headers, json=payload)
+                response.raise_for_status()
+                data = response.json()
+                for deal in data.get("results", []):
+                    properties = deal.get("properties", {})
+                    plate = find_deal_plate(properties.get("dealname"), chunk)
+                    created = properties.get("createdate") or ''
+                    if plate and (plate not in newest or created > newest[plate][0]):
+                        newest[plate] = (created, properties.get("kilometer"))
+                after = data.get("paging", {}).get("next", {}).get("after")
+                if not after:
+                    break
+                payload["after"] = after
+            answered.extend(chunk)
+        except Exception as e:
+            print(f"Fejl ved hentning af kilometertal fra HubSpot for {', '.join(chunk)}: {str(e)}")
+
+    return {plate: newest[plate][1] if plate in newest else None for plate in answered}
 
-    response = requests.post(url, headers=headers, json=params)
-    return response.json()["data"][0]["engine"]
 
+SYNSBASEN_EXPANSIONS = ['engine', 'weight', 'appraisals']
 
-def fetch_engine_data(registration_number, api_token):
-    url = f"https://api.synsbasen.dk/v1/vehicles/registration/{registration_number}?expand[]=engine"
+
+@instrumented('synsbasen')
+def fetch_vehicle_record(registration_number, api_token):
+    # Ét kald med alle udvidelser i stedet for et kald pr. datatype
+    url = f"{SYNSBASEN_BASE_URL}/v1/vehicles/registration/{registration_number}"
     headers = {
         "Authorization": f"Bearer {api_token}",
         "Content-Type": "application/json"
     }
+    params = [('expand[]', expansion) for expansion in SYNSBASEN_EXPANSIONS]
 
     try:
-        response = requests.get(url, headers=headers)
+        response = http_request('GET', url, headers=headers, params=params)
         response.raise_for_status()
 
-        data = response.json()["data"]
-        engine_data = data.get("engine", {})
-        return {
-            'fuel_efficiency': engine_data.get('fuel_efficiency'),
-            'fuel_type': engine_data.get('fuel_type')
-        }
+        return build_vehicle_record(registration_number, response.json()["data"])
     except Exception as e:
-        raise Exception(f"Fejl ved hentning af motordata: {str(e)}")
+        raise Exception(f"Fejl ved hentning af køretøjsdata: {str(e)}")
+
+
+SYNSBASEN_BULK_SIZE = 100  # nummerplader pr. forespørgsel og pr. side
 
 
-def fetch_weight_data(registration_number, api_token):
-    url = f"https://api.synsbasen.dk/v1/vehicles/registration/{registration_number}?expand[]=weight"
+@instrumented('synsbasen')
+def fetch_vehicle_records(registration_numbers, api_token):
+    # Mange køretøjer via forespørgsels-endpointet: én forespørgsel (plus evt. ekstra sider)
+    # pr. 100 plader i stedet for én GET pr. plade. Returnerer {nummerplade: record}.
+    url = f"{SYNSBASEN_BASE_URL}/v1/vehicles"
     headers = {
         "Authorization": f"Bearer {api_token}",
         "Content-Type": "application/json"
     }
+    plates = sorted({normalize_registration_number(plate) for plate in registration_numbers if plate})
+    records = {}
+
+    for start in range(0, len(plates), SYNSBASEN_BULK_SIZE):
+        chunk = plates[start:start + SYNSBASEN_BULK_SIZE]
+        params = {
+            "query": {
+                "registration_in": chunk
+            },
+            "method": "SELECT",
+            "expand[]": SYNSBASEN_EXPANSIONS,
+            "per_page": SYNSBASEN_BULK_SIZE,
+            "page": 1
+        }
+        try:
+            while True:
+                response = http_request('POST', url, headers=headers, json=params)
+                response.raise_for_status()
+                body = response.json()
+                vehicles = body.get("data") or []
+                for data in vehicles:
+                    key = normalize_registration_number(str(data.get("registration") or ''))
+                    if key in chunk:
+                        records[key] = build_vehicle_record(key, data)
+                total_pages = (body.get("meta") or {}).get("total_pages")
+                if len(vehicles) < SYNSBASEN_BULK_SIZE or (total_pages and params["page"] >= total_pages):
+                    break
+                params["page"] += 1
+        except Exception as e:
+            print(f"Fejl ved hentning af køretøjsdata for {len(chunk)} plader: {str(e)}")
 
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+    return records
 
-        data = response.json()["data"]
-        weight_data = data.get("weight", {})
-        return {
-            'total_weight': weight_data.get('total_weight')
-        }
-    except Exception as e:
-        raise Exception(f"Fejl ved hentning af vægtdata: {str(e)}")
 
+def build_vehicle_record(registration_number, data):
+    return {
+        'registration_number': registration_number,
+        'basic': parse_basic_vehicle_data(data),
+        'engine': parse_engine_data(data),
+        'weight': parse_weight_data(data),
+        'appraisals': data.get('appraisals') or {}
+    }
 
-def update_km_data(sheets, handelspris, norm_km, current_km):
-    max_attempts = 3
-    for attempt in range(max_attempts):
-        try:
-            updates = [
-                {'range': 'Ark1!E7', 'values': [[handelspris]]},
-                {'range': 'Ark1!E8', 'values': [[norm_km]]},
-                {'range': 'Ark1!E9', 'values': [[current_km]]}
-            ]
-
-            for update in updates:
-                sheets.values().update(
-                    spreadsheetId=KM_SPREADSHEET_ID,
-                    range=update['range'],
-                    valueInputOption='RAW',
-                    body={'values': update['values']}
-                ).execute()
-            break
-        except socket.error:
-            if attempt < max_attempts - 1:
-                time.sleep(2 ** attempt)
-                continue
-            raise
 
+@instrumented('køretøjsdata')
+def get_vehicle_record(registration_number, api_token):
+    key = normalize_registration_number(registration_number)
+    vehicle_found, vehicle = cache_get('vehicle', key)
+    appraisals_found, appraisals = cache_get('appraisals', key)
+    if vehicle_found and appraisals_found:
+        vehicle['appraisals'] = appraisals
+        return vehicle
+
+    vehicle = fetch_vehicle_record(registration_number, api_token)
+    cache_set('vehicle', key, {name: value for name, value in vehicle.items() if name != 'appraisals'})
+    cache_set('appraisals', key, vehicle['appraisals'])
+    return vehicle
+
+
+def get_vehicle_records(registration_numbers, api_token):
+    records = {}
+    missing = []
+    for registration_number in registration_numbers:
+        key = normalize_registration_number(registration_number)
+        vehicle_found, vehicle = cache_get('vehicle', key)
+        appraisals_found, appraisals = cache_get('appraisals', key)
+        if vehicle_found and appraisals_found:
+            vehicle['appraisals'] = appraisals
+            records[key] = vehicle
+        else:
+            missing.append(key)
+
+    for key, vehicle in fetch_vehicle_records(missing, api_token).items():
+        cache_set('vehicle', key, {name: value for name, value in vehicle.items() if name != 'appraisals'})
+        cache_set('appraisals', key, vehicle['appraisals'])
+        records[key] = vehicle
+    return records
+
+
+@instrumented('kilometertal')
+def get_hubspot_mileage(registration_number, api_key):
+    key = normalize_registration_number(registration_number)
+    found, mileage = cache_get('hubspot_mileage', key)
+    if found:
+        return mileage
+
+    mileage = fetch_hubspot_mileage(registration_number, api_key)
+    # Manglende kilometertal (eller fejl) caches ikke, så næste tilbud prøver igen
+    if mileage:
+        cache_set('hubspot_mileage', key, mileage)
+    return mileage
+
+
+def get_hubspot_mileages(registration_numbers, api_key):
+    mileages = {}
+    missing = []
+    for registration_number in registration_numbers:
+        key = normalize_registration_number(registration_number)
+        found, mileage = cache_get('hubspot_mileage', key)
+        if found:
+            mileages[key] = mileage
+        else:
+            missing.append(key)
 
-def fetch_evaluation_data(registration_number, api_token):
-    url = f"https://api.synsbasen.dk/v1/vehicles/registration/{registration_number}?expand[]=appraisals"
-    headers = {
-        "Authorization": f"Bearer {api_token}",
-        "Content-Type": "application/json"
+    for key, mileage in fetch_hubspot_mileages(missing, api_key).items():
+        # Manglende kilometertal caches ikke, men returneres som None så de ikke slås op igen
+        if mileage:
+            cache_set('hubspot_mileage', key, mileage)
+        mileages[key] = mileage
+    return mileages
+
+
+_prefetch_executor = None
+_prefetch_executor_lock = threading.Lock()
+
+
+def get_prefetch_executor():
+    global _prefetch_executor
+    with _prefetch_executor_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='prefetch')
+        return _prefetch_executor
+
+
+def start_prefetch(registration_number, api_token, hubspot_api_key, metrics=None):
+    # Alt der ikke afhænger af de indtastede værdier hentes samtidig, mens operatøren taster.
+    # Handelspris-rækken (Ark1!E19:I19) beregnes ud fra E7:E9 og kan først hentes efter input.
+    executor = get_prefetch_executor()
+
+    def submit(func, *args):
+        return executor.submit(with_quote_metrics(metrics, func) if metrics else func, *args)
+
+    return {
+        'vehicle': submit(get_vehicle_record, registration_number, api_token),
+        'hubspot_mileage': submit(get_hubspot_mileage, registration_number, hubspot_api_key),
+        'exchange_rate': submit(get_eur_exchange_rate),
+        'sheets': submit(warm_sheets_service)
     }
 
-    try:
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
 
-        appraisals = response.json().get("data", {}).get("appraisals", {})
+def parse_basic_vehicle_data(data):
+    return {
+        'fuel_efficiency': data.get('fuel_efficiency'),
+        'fuel_type': data.get('fuel_type'),
+        'registration_date': data.get('first_registration_date'),
+        'model': data.get('model'),
+        'version': data.get('version'),
+        'brand': data.get('brand'),
+        'type': data.get('kind'),
+        'total_weight': data.get('total_weight')
+    }
+
+
+def parse_engine_data(data):
+    engine_data = data.get("engine") or {}
+    return {
+        'fuel_efficiency': engine_data.get('fuel_efficiency'),
+        'fuel_type': engine_data.get('fuel_type')
+    }
+
 
+def parse_weight_data(data):
+    weight_data = data.get("weight") or {}
+    return {
+        'total_weight': weight_data.get('total_weight')
+    }
+
+
+_last_km_fingerprint = None
+
+
+def get_km_sheet_fingerprint(sheets, refresh=False):
+    # refresh=True læser arket igen uanset KM_FINGERPRINT_TTL
+    global _last_km_fingerprint
+    if not refresh:
+        found, fingerprint = cache_get('km_fingerprint', KM_SPREADSHEET_ID)
+        if found:
+            _last_km_fingerprint = fingerprint
+            return fingerprint
+
+    formulas = sheets_batch_get(sheets, KM_SPREADSHEET_ID, KM_FINGERPRINT_RANGES, value_render_option='FORMULA')
+    # Inputcellerne skifter ved hvert tilbud og må ikke påvirke fingeraftrykket
+    masked = [[None if (row_index, column_index) in KM_INPUT_CELLS else value
+               for column_index, value in enumerate(row)] for row_index, row in enumerate(formulas[0])]
+    # Med ét område hashes det som før, så gemte fingeraftryk stadig passer
+    fingerprinted = masked if len(formulas) == 1 else [masked] + list(formulas[1:])
+    fingerprint = hashlib.sha256(json.dumps(fingerprinted).encode('utf-8')).hexdigest()[:16]
+    cache_set('km_fingerprint', KM_SPREADSHEET_ID, fingerprint)
+    _last_km_fingerprint = fingerprint
+    return fingerprint
+
+
+def current_km_fingerprint():
+    # Fingeraftrykket fra seneste opslag gemmes med tilbuddet, så genberegning kan se om
+    # KM-arket er ændret siden. None når cachen er slået fra.
+    return _last_km_fingerprint if _cache_mode != 'off' else None
+
+
+def trade_row_cache_key(fingerprint, handelspris, norm_km, current_km):
+    return f"{fingerprint}:{float(handelspris)!r}:{float(norm_km)!r}:{float(current_km)!r}"
+
+
+@instrumented('km_ark')
+def update_km_data(sheets, handelspris, norm_km, current_km, refresh=False):
+    # Rækken afhænger kun af de tre input og arkets formler; ved cache-hit springes
+    # både skrivning og læsning over. refresh=True læser altid arket og gemmer resultatet.
+    cache_key = None
+    if _cache_mode != 'off':
+        fingerprint = get_km_sheet_fingerprint(sheets)
+        cache_key = trade_row_cache_key(fingerprint, handelspris, norm_km, current_km)
+        if not refresh:
+            found, trade_row = cache_get('trade_row', cache_key)
+            if found:
+                return trade_row
+
+    # Skriv input og læs handelspris-rækken i ét trin på KM-arket
+    updates = [
+        {'range': 'Ark1!E7:E9', 'values': [[handelspris], [norm_km], [current_km]]}
+    ]
+    with SPREADSHEET_LOCKS[KM_SPREADSHEET_ID]:
+        sheets_batch_update(sheets, KM_SPREADSHEET_ID, updates)
+        trade_values, = sheets_batch_get(sheets, KM_SPREADSHEET_ID, ['Ark1!E19:I19'])
+    trade_row = (trade_values or [[]])[0]
+    if cache_key and trade_row:
+        cache_set('trade_row', cache_key, trade_row)
+    return trade_row
+
+
+def parse_evaluation_data(appraisals):
+    try:
         if not appraisals.get("service_available") or not appraisals.get("data"):
             raise Exception("Ingen vurderingsdata tilgængelig")
 
@@ -253,115 +1161,316 @@ def calculate_vehicle_age(registration_date):
     reg_date = datetime.strptime(registration_date, "%Y-%m-%d")
     return (current_date - reg_date).days // 365
 
-def find_trade_price_based_on_age(sheets, vehicle_age):
-    max_attempts = 3
-    for attempt in range(max_attempts):
-        try:
-            result = sheets.values().get(
-                spreadsheetId=KM_SPREADSHEET_ID,
-                range='Ark1!E19:I19'
-            ).execute()
-            values = result.get('values', [[]])[0]
-
-            if vehicle_age < 1:
-                trade_price = values[0]
-                age_group = "0-1 år"
-            elif 1 <= vehicle_age < 2:
-                trade_price = values[1]
-                age_group = "1-2 år"
-            elif 2 <= vehicle_age < 3:
-                trade_price = values[2]
-                age_group = "2-3 år"
-            elif 3 <= vehicle_age < 10:
-                trade_price = values[3]
-                age_group = "3-9 år"
-            else:
-                trade_price = values[4]
-                age_group = "Over 10 år"
+AGE_GROUPS = ["0-1 år", "1-2 år", "2-3 år", "3-9 år", "Over 10 år"]  # kolonnerne i Ark1!E19:I19
 
-            return float(trade_price) * 1000, age_group
-        except socket.error:
-            if attempt < max_attempts - 1:
-                time.sleep(2 ** attempt)
-                continue
-            raise
 
-def update_co2_in_sheets(sheets, fuel_type, fuel_efficiency, registration_date, vehicle_type):
-    max_attempts = 3
-    for attempt in range(max_attempts):
+def get_age_group(vehicle_age):
+    if vehicle_age < 1:
+        return "0-1 år"
+    elif 1 <= vehicle_age < 2:
+        return "1-2 år"
+    elif 2 <= vehicle_age < 3:
+        return "2-3 år"
+    elif 3 <= vehicle_age < 10:
+        return "3-9 år"
+    return "Over 10 år"
+
+
+def trade_price_for_age_group(trade_row, age_group):
+    return float(trade_row[AGE_GROUPS.index(age_group)]) * 1000
+
+
+def find_trade_price_based_on_age(trade_row, vehicle_age):
+    age_group = get_age_group(vehicle_age)
+    return trade_price_for_age_group(trade_row, age_group), age_group
+
+def get_co2_norm(registration_date):
+    reg_date = datetime.strptime(registration_date, "%Y-%m-%d")
+    wltp_cutoff_date = datetime.strptime("2017-09-01", "%Y-%m-%d")
+    return "WLTP" if reg_date >= wltp_cutoff_date else "NEDC"
+
+def build_co2_updates(fuel_type, fuel_efficiency, registration_date):
+    if isinstance(fuel_efficiency, str):
+        fuel_efficiency_formatted = fuel_efficiency.replace(".", ".")
+    else:
+        fuel_efficiency_formatted = str(fuel_efficiency).replace(".", ".")
+
+    co2_norm = get_co2_norm(registration_date)
+
+    return [
+        {'range': 'Værktøj til CO2!C26', 'values': [[co2_norm]]},
+        {'range': 'Værktøj til CO2!C27', 'values': [[fuel_type]]},
+        {'range': 'Værktøj til CO2!C25', 'values': [[fuel_efficiency_formatted]]}
+    ]
+
+def get_weight_category(total_weight):
+    return "over 3.000 kg og som enten er åben eller uden sideruder bag føresædet" if total_weight > 3000 else "Alle andre"
+
+def build_vehicle_updates(vehicle_type, total_weight, handelspris, new_price):
+    if vehicle_type == "Varebil":
+        return [
+            {'range': 'Brugte Varebiler!L21', 'values': [[int(handelspris)]]},
+            {'range': 'Brugte Varebiler!L22', 'values': [[int(new_price)]]},
+            {'range': 'Brugte Varebiler!L27', 'values': [[get_weight_category(total_weight)]]}
+        ]
+    return [
+        {'range': 'handelspris01', 'values': [[int(handelspris)]]},
+        {'range': 'nypris01', 'values': [[int(new_price)]]}
+    ]
+
+def get_co2_from_sheets(sheets, fuel_type, fuel_efficiency, registration_date, extra_updates=()):
+    updates = build_co2_updates(fuel_type, fuel_efficiency, registration_date) + list(extra_updates)
+    with SPREADSHEET_LOCKS[TAX_SPREADSHEET_ID]:
+        sheets_batch_update(sheets, TAX_SPREADSHEET_ID, updates)
+        co2_values, = sheets_batch_get(sheets, TAX_SPREADSHEET_ID, ['Værktøj til CO2!C30'])
+    return (co2_values or [[0]])[0][0]
+
+def get_export_tax(sheets, vehicle_type, fuel_type, fuel_efficiency, registration_date,
+                   total_weight, handelspris, new_price, co2_value=None):
+    vehicle_updates = build_vehicle_updates(vehicle_type, total_weight, handelspris, new_price)
+    co2_range = 'Brugte Varebiler!L23' if vehicle_type == "Varebil" else 'co2km01'
+    tax_range = 'Brugte Varebiler!G32' if vehicle_type == "Varebil" else 'finalTax01'
+
+    with SPREADSHEET_LOCKS[TAX_SPREADSHEET_ID]:
+        if co2_value is None:
+            # Trin 1: alle input til CO2-værktøjet og afgiftsberegningen i ét kald, læs CO2-resultatet
+            co2_value = get_co2_from_sheets(sheets, fuel_type, fuel_efficiency, registration_date, vehicle_updates)
+            vehicle_updates = []
+
+        # Trin 2: skriv CO2 (og evt. køretøjsdata) og læs eksportafgiften
+        sheets_batch_update(sheets, TAX_SPREADSHEET_ID,
+                            vehicle_updates + [{'range': co2_range, 'values': [[co2_value]]}])
+        tax_values, = sheets_batch_get(sheets, TAX_SPREADSHEET_ID, [tax_range])
+    return float((tax_values or [[0]])[0][0])
+
+
+# Lokal CO2-omregning fra km/l til g/km. Gram CO2 pr. liter brændstof pr. norm;
+# NEDC-værdier er opregnet til WLTP-niveau. Kontroller mod arket med 'verify-co2'.
+CO2_GRAMS_PER_LITER = {
+    'WLTP': {'benzin': 2370, 'diesel': 2650},
+    'NEDC': {'benzin': 2370 * 1.21, 'diesel': 2650 * 1.21}
+}
+# Brændstoftyper fra Synsbasen der omregnes som benzin/diesel eller uden CO2
+CO2_FUEL_ALIASES = {
+    'benzin': 'benzin',
+    'hybrid': 'benzin',
+    'plug-in hybrid': 'benzin',
+    'diesel': 'diesel',
+    'el': None,
+    'brint': None
+}
+
+
+def calculate_co2(fuel_type, fuel_efficiency, registration_date):
+    fuel_key = str(fuel_type or '').strip().lower()
+    if fuel_key not in CO2_FUEL_ALIASES:
+        raise Exception(f"Ukendt drivmiddel til CO2-omregning: {fuel_type}")
+    fuel = CO2_FUEL_ALIASES[fuel_key]
+    if fuel is None:
+        return 0.0
+
+    km_per_liter = float(str(fuel_efficiency).replace(",", "."))
+    if km_per_liter <= 0:
+        raise Exception(f"Ugyldigt brændstofforbrug: {fuel_efficiency}")
+
+    grams_per_liter = CO2_GRAMS_PER_LITER[get_co2_norm(registration_date)][fuel]
+    return float(round(grams_per_liter / km_per_liter))
+
+
+def verify_co2(rows, api_token, tolerance=1.0):
+    # Sammenligner den lokale CO2-omregning med "Værktøj til CO2" for et udsnit af plader
+    sheets = get_sheets_service()
+    mismatches = 0
+    checked = 0
+
+    for row in rows:
+        registration_number = row['nummerplade'].strip()
         try:
-            if isinstance(fuel_efficiency, str):
-                fuel_efficiency_formatted = fuel_efficiency.replace(".", ".")
-            else:
-                fuel_efficiency_formatted = str(fuel_efficiency).replace(".", ".")
-
-            reg_date = datetime.strptime(registration_date, "%Y-%m-%d")
-            wltp_cutoff_date = datetime.strptime("2017-09-01", "%Y-%m-%d")
-            co2_norm = "WLTP" if reg_date >= wltp_cutoff_date else "NEDC"
-
-            updates = [
-                {'range': 'Værktøj til CO2!C26', 'values': [[co2_norm]]},
-                {'range': 'Værktøj til CO2!C27', 'values': [[fuel_type]]},
-                {'range': 'Værktøj til CO2!C25', 'values': [[fuel_efficiency_formatted]]}
-            ]
-
-            for update in updates:
-                sheets.values().update(
-                    spreadsheetId=TAX_SPREADSHEET_ID,
-                    range=update['range'],
-                    valueInputOption='USER_ENTERED',
-                    body={'values': update['values']}
-                ).execute()
-
-            result = sheets.values().get(
-                spreadsheetId=TAX_SPREADSHEET_ID,
-                range='Værktøj til CO2!C30'
-            ).execute()
-            co2_value = result.get('values', [[0]])[0][0]
-
-            target_range = 'Brugte Varebiler!L23' if vehicle_type == "Varebil" else 'co2km01'
-            sheets.values().update(
-                spreadsheetId=TAX_SPREADSHEET_ID,
-                range=target_range,
-                valueInputOption='USER_ENTERED',
-                body={'values': [[co2_value]]}
-            ).execute()
+            vehicle = get_vehicle_record(registration_number, api_token)
+            engine_data = vehicle['engine']
+            registration_date = vehicle['basic']['registration_date']
+            sheet_co2 = float(get_co2_from_sheets(sheets, engine_data['fuel_type'],
+                                                  engine_data['fuel_efficiency'], registration_date))
+            local_co2 = calculate_co2(engine_data['fuel_type'], engine_data['fuel_efficiency'], registration_date)
+        except Exception as e:
+            print(f"{registration_number}: fejl - {e}")
+            continue
+
+        checked += 1
+        difference = local_co2 - sheet_co2
+        status = "OK" if abs(difference) <= tolerance else "AFVIGER"
+        if status != "OK":
+            mismatches += 1
+        print(f"{registration_number} ({engine_data['fuel_type']}, {get_co2_norm(registration_date)}): "
+              f"ark {sheet_co2:g} g/km / lokal {local_co2:g} g/km [{status}]")
+
+    print(f"\n{checked} kontrolleret, {mismatches} afviger (tolerance {tolerance:g} g/km)")
+    return mismatches
+
+
+# Lokal afgiftsberegning. Satserne skal følge afgiftsarket - kontroller med
+# 'verify-tax' når satserne opdateres. Beløbsgrænser er i kr., CO2-tillæg i kr. pr. g/km.
+EXPORT_TAX_RATES = [
+    {
+        'version': '2024-01',
+        'valid_from': '2024-01-01',
+        'personbil': {
+            'brackets': [(68500, 0.25), (212900, 0.85), (None, 1.50)],
+            'co2_tiers': [(109, 284), (139, 567), (None, 1134)],
+            'bundfradrag': 23800,
+            'fuel_adjustments': {'el': {'share': 0.40, 'bundfradrag': 165000}}
+        },
+        'varebil': {
+            'Alle andre': {
+                'brackets': [(68500, 0.50), (None, 0.85)],
+                'co2_tiers': [(None, 284)],
+                'bundfradrag': 0,
+                'fuel_adjustments': {}
+            },
+            'over 3.000 kg og som enten er åben eller uden sideruder bag føresædet': {
+                'brackets': [(None, 0.30)],
+                'co2_tiers': [(None, 142)],
+                'bundfradrag': 0,
+                'fuel_adjustments': {}
+            }
+        }
+    },
+    {
+        'version': '2025-01',
+        'valid_from': '2025-01-01',
+        'personbil': {
+            'brackets': [(72100, 0.25), (224000, 0.85), (None, 1.50)],
+            'co2_tiers': [(109, 299), (139, 597), (None, 1194)],
+            'bundfradrag': 25000,
+            'fuel_adjustments': {'el': {'share': 0.40, 'bundfradrag': 165000}}
+        },
+        'varebil': {
+            'Alle andre': {
+                'brackets': [(72100, 0.50), (None, 0.85)],
+                'co2_tiers': [(None, 299)],
+                'bundfradrag': 0,
+                'fuel_adjustments': {}
+            },
+            'over 3.000 kg og som enten er åben eller uden sideruder bag føresædet': {
+                'brackets': [(None, 0.30)],
+                'co2_tiers': [(None, 150)],
+                'bundfradrag': 0,
+                'fuel_adjustments': {}
+            }
+        }
+    }
+]
+
+
+def select_export_tax_rates(date=None):
+    date_str = (date or datetime.now()).strftime('%Y-%m-%d')
+    valid_rates = [rates for rates in EXPORT_TAX_RATES if rates['valid_from'] <= date_str]
+    if not valid_rates:
+        raise Exception(f"Ingen afgiftssatser gælder for {date_str}")
+    return max(valid_rates, key=lambda rates: rates['valid_from'])
+
+
+def apply_tax_brackets(amount, brackets):
+    # brackets er (øvre grænse, sats) i stigende orden; None betyder ingen øvre grænse
+    tax = 0.0
+    lower = 0
+    for upper, rate in brackets:
+        if upper is None or amount <= upper:
+            tax += max(0, amount - lower) * rate
             break
-        except socket.error:
-            if attempt < max_attempts - 1:
-                time.sleep(2 ** attempt)
-                continue
-            raise
+        tax += (upper - lower) * rate
+        lower = upper
+    return tax
 
-def update_vehicle_data(sheets, vehicle_type, total_weight, handelspris, new_price):
+
+def calculate_local_export_tax(vehicle_type, handelspris, new_price, co2_km, fuel_type=None,
+                               total_weight=0, rates=None):
+    rates = rates or select_export_tax_rates()
     if vehicle_type == "Varebil":
-        weight_category = "over 3.000 kg og som enten er åben eller uden sideruder bag føresædet" if total_weight > 3000 else "Alle andre"
-        updates = [
-            {'range': 'Brugte Varebiler!L21', 'values': [[str(int(handelspris))]]},
-            {'range': 'Brugte Varebiler!L22', 'values': [[str(int(new_price))]]},
-            {'range': 'Brugte Varebiler!L27', 'values': [[weight_category]]}
-        ]
+        category_rates = rates['varebil'][get_weight_category(total_weight)]
     else:
-        updates = [
-            {'range': 'handelspris01', 'values': [[str(int(handelspris))]]},
-            {'range': 'nypris01', 'values': [[str(int(new_price))]]}
-        ]
+        category_rates = rates['personbil']
+
+    new_price = float(new_price)
+    gross_tax = (apply_tax_brackets(new_price, category_rates['brackets'])
+                 + apply_tax_brackets(float(co2_km), category_rates['co2_tiers']))
+
+    bundfradrag = category_rates['bundfradrag']
+    adjustment = category_rates['fuel_adjustments'].get(str(fuel_type or '').lower())
+    if adjustment:
+        gross_tax *= adjustment['share']
+        bundfradrag = adjustment['bundfradrag']
+    full_tax = max(0.0, gross_tax - bundfradrag)
+
+    # Brugt køretøj: afgiften nedskrives med samme andel som værditabet
+    if new_price <= 0:
+        return 0.0
+    return round(full_tax * min(1.0, float(handelspris) / new_price), 2)
+
+
+@instrumented('eksportafgift')
+def calculate_export_tax(sheets, vehicle_type, tax_inputs, handelspris, new_price):
+    # tax_inputs som fra build_tax_inputs: brændstof, forbrug, 1. registrering og totalvægt
+    fuel_type = tax_inputs['fuel_type']
+    fuel_efficiency = tax_inputs['fuel_efficiency']
+    registration_date = tax_inputs['registration_date']
+    total_weight = tax_inputs['total_weight']
+    co2_value = None
+    if CO2_ENGINE == 'local':
+        co2_value = calculate_co2(fuel_type, fuel_efficiency, registration_date)
+
+    if TAX_ENGINE == 'local':
+        if co2_value is None:
+            co2_value = get_co2_from_sheets(sheets, fuel_type, fuel_efficiency, registration_date)
+        return calculate_local_export_tax(vehicle_type, handelspris, new_price, float(co2_value),
+                                          fuel_type, total_weight)
+    return get_export_tax(sheets, vehicle_type, fuel_type, fuel_efficiency,
+                          registration_date, total_weight, handelspris, new_price, co2_value)
+
+
+def verify_export_tax(rows, api_token, tolerance=1.0):
+    # Kører hver række gennem både arket og den lokale beregning og viser forskellen
+    sheets = get_sheets_service()
+    mismatches = 0
+    checked = 0
+
+    for row in rows:
+        registration_number = row['nummerplade'].strip()
+        try:
+            handelspris = float(row['handelspris'])
+            vehicle = get_vehicle_record(registration_number, api_token)
+            basic_data = vehicle['basic']
+            engine_data = vehicle['engine']
+            vehicle_type = basic_data['type']
+            total_weight = vehicle['weight'].get('total_weight') or 0
 
-    for update in updates:
-        sheets.values().update(
-            spreadsheetId=TAX_SPREADSHEET_ID,
-            range=update['range'],
-            valueInputOption='RAW',
-            body={'values': update['values']}
-        ).execute()
+            new_price = calculate_new_price(parse_evaluation_data(vehicle['appraisals']), row.get('nypris') or None)
+            if new_price is None:
+                print(f"{registration_number}: springes over - ingen nypris")
+                continue
+
+            co2_value = get_co2_from_sheets(sheets, engine_data['fuel_type'], engine_data['fuel_efficiency'],
+                                            basic_data['registration_date'])
+            sheet_tax = get_export_tax(sheets, vehicle_type, engine_data['fuel_type'],
+                                       engine_data['fuel_efficiency'], basic_data['registration_date'],
+                                       total_weight, handelspris, new_price, co2_value=co2_value)
+            local_tax = calculate_local_export_tax(vehicle_type, handelspris, new_price, float(co2_value),
+                                                   engine_data['fuel_type'], total_weight)
+        except Exception as e:
+            print(f"{registration_number}: fejl - {e}")
+            continue
+
+        checked += 1
+        difference = local_tax - sheet_tax
+        status = "OK" if abs(difference) <= tolerance else "AFVIGER"
+        if status != "OK":
+            mismatches += 1
+        print(f"{registration_number}: ark {sheet_tax:,.2f} kr. / lokal {local_tax:,.2f} kr. "
+              f"/ forskel {difference:,.2f} kr. [{status}]")
+
+    print(f"\n{checked} kontrolleret, {mismatches} afviger (tolerance {tolerance:.2f} kr.)")
+    return mismatches
 
-def get_export_tax(sheets, vehicle_type):
-    tax_range = 'Brugte Varebiler!G32' if vehicle_type == "Varebil" else 'finalTax01'
-    result = sheets.values().get(
-        spreadsheetId=TAX_SPREADSHEET_ID,
-        range=tax_range
-    ).execute()
-    return float(result.get('values', [[0]])[0][0])
 
 def calculate_new_price(eval_data, manual_price=None):
     if manual_price is not None:
@@ -382,162 +1491,1406 @@ def calculate_new_price(eval_data, manual_price=None):
         return None
 
 
-def get_export_tax(sheets, vehicle_type, registration_tax):
-    # Hent altid eksportafgift fra sheet
-    tax_range = 'Brugte Varebiler!G32' if vehicle_type == "Varebil" else 'finalTax01'
-    result = sheets.values().get(
-        spreadsheetId=TAX_SPREADSHEET_ID,
-        range=tax_range
-    ).execute()
+REDUCED_TAX_THRESHOLD = 50000
+REDUCED_TAX_HIGH_RATE = 0.85
+REDUCED_TAX_HIGH_DEDUCTION = 3000
+REDUCED_TAX_LOW_DEDUCTION = 11000
+
+
+def calculate_reduced_tax(export_tax):
+    if export_tax > REDUCED_TAX_THRESHOLD:
+        return export_tax * REDUCED_TAX_HIGH_RATE - REDUCED_TAX_HIGH_DEDUCTION
+    return export_tax - REDUCED_TAX_LOW_DEDUCTION
+
+
+def build_vehicle_info(basic_data):
+    brand = basic_data.get('brand', 'N/A')
+    model = basic_data.get('model', 'N/A')
+    version = basic_data.get('version', 'N/A')
+    fuel_type = basic_data.get('fuel_type', 'N/A')
+    return f"{brand} {model} {version} {fuel_type}"
+
+
+def build_tax_inputs(vehicle):
+    # Det afgiftsberegningen skal bruge ud over priserne, så et tilbud kan genberegnes uden API-kald
+    return {
+        'fuel_type': vehicle['engine'].get('fuel_type'),
+        'fuel_efficiency': vehicle['engine'].get('fuel_efficiency'),
+        'registration_date': vehicle['basic']['registration_date'],
+        'total_weight': vehicle['weight'].get('total_weight') or 0
+    }
 
-    # Returner altid værdien fra sheetet
-    return float(result.get('values', [[0]])[0][0])
 
+def build_quote_sources(km_source, is_manual_price, exchange_rate):
+    return {
+        'km': km_source,
+        'nypris': 'manuel' if is_manual_price else 'synsbasen',
+        'valutakurs': exchange_rate['source'],
+        'eksportafgift': TAX_ENGINE,
+        'co2': CO2_ENGINE
+    }
 
 
-def log_to_file(registration_number, type, vehicle_info, new_price, export_tax, reduced_tax, handelspris_input, norm_km_input, current_km_input, sheet_handelspris, age_group, eur_price, dkk_converted, total_sum):
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
+def load_quote_vehicle(registration_number, api_token, hubspot_api_key, current_km_input=None, manual_price=None,
+                       prefetched=None):
+    # Alt om køretøjet der ikke afhænger af handelspris og Euro pris. prefetched kan indeholde
+    # 'vehicle' og/eller 'hubspot_mileage' der allerede er slået op (også når mileage er None).
+    prefetched = prefetched or {}
+    if 'vehicle' in prefetched:
+        vehicle = prefetched['vehicle']
+    else:
+        vehicle = get_vehicle_record(registration_number, api_token)
+    basic_data = vehicle['basic']
+    eval_data = parse_evaluation_data(vehicle['appraisals'])
+
+    km_source = 'input'
+    if current_km_input is None:
+        if 'hubspot_mileage' in prefetched:
+            hubspot_km = prefetched['hubspot_mileage']
+        else:
+            hubspot_km = get_hubspot_mileage(registration_number, hubspot_api_key)
+        if not hubspot_km:
+            raise Exception("Kilometertal mangler og findes ikke i HubSpot")
+        current_km_input = float(hubspot_km)
+        km_source = 'hubspot'
+
+    new_price = calculate_new_price(eval_data)
+    is_manual_price = False
+    if new_price is None:
+        if manual_price is None:
+            raise Exception("Kunne ikke beregne nypris automatisk og ingen manuel nypris angivet")
+        new_price = calculate_new_price(eval_data, manual_price)
+        is_manual_price = True
+
+    return {
+        'registration_number': registration_number,
+        'vehicle': vehicle,
+        'basic': basic_data,
+        'vehicle_type': basic_data['type'],
+        'total_weight': vehicle['weight'].get('total_weight') or 0,
+        'vehicle_age': calculate_vehicle_age(basic_data['registration_date']),
+        'current_km_input': current_km_input,
+        'km_source': km_source,
+        'new_price': new_price,
+        'is_manual_price': is_manual_price
+    }
 
-    filename = f"logs/vehicle_export_log_{datetime.now().strftime('%Y-%m-%d')}.txt"
 
+def calculate_quote_tax(loaded, handelspris_input, norm_km_input, sheets=None):
+    # KM-arket og eksportafgiften - alt der afhænger af handelsprisen, men ikke af Euro prisen
+    sheets = sheets or get_sheets_service()
+    vehicle = loaded['vehicle']
+    basic_data = loaded['basic']
+    trade_row = update_km_data(sheets, handelspris_input, norm_km_input, loaded['current_km_input'])
+    handelspris, age_group = find_trade_price_based_on_age(trade_row, loaded['vehicle_age'])
+
+    tax_inputs = build_tax_inputs(vehicle)
+    export_tax = calculate_export_tax(sheets, loaded['vehicle_type'], tax_inputs, handelspris, loaded['new_price'])
+
+    return {
+        'registration_number': loaded['registration_number'],
+        'vehicle_type': loaded['vehicle_type'],
+        'vehicle_info': build_vehicle_info(basic_data),
+        'brand': basic_data.get('brand'),
+        'model': basic_data.get('model'),
+        'vehicle_age': loaded['vehicle_age'],
+        'total_weight': loaded['total_weight'],
+        'handelspris_input': handelspris_input,
+        'norm_km_input': norm_km_input,
+        'current_km_input': loaded['current_km_input'],
+        'km_source': loaded['km_source'],
+        'sheet_handelspris': handelspris,
+        'age_group': age_group,
+        'new_price': loaded['new_price'],
+        'is_manual_price': loaded['is_manual_price'],
+        'export_tax': export_tax,
+        'reduced_tax': calculate_reduced_tax(export_tax),
+        'tax_inputs': tax_inputs,
+        'km_fingerprint': current_km_fingerprint()
+    }
+
+
+def complete_quote(quote, eur_price, exchange_rate):
+    # Sidste trin: Euro prisen omregnes og lægges til den reducerede afgift
+    quote['eur_price'] = eur_price
+    quote['exchange_rate'] = exchange_rate
+    quote['dkk_converted'] = eur_price * exchange_rate['rate']
+    quote['total_sum'] = quote['reduced_tax'] + quote['dkk_converted']
+    quote['sources'] = build_quote_sources(quote['km_source'], quote['is_manual_price'], exchange_rate)
+    return quote
+
+
+def quote_vehicle(registration_number, handelspris_input, norm_km_input, eur_price, api_token,
+                  hubspot_api_key, current_km_input=None, manual_price=None, prefetched=None):
+    # Samme trin som main(), men uden input() - bruges af batch-kørsler og tilbudsserveren
+    loaded = load_quote_vehicle(registration_number, api_token, hubspot_api_key, current_km_input, manual_price,
+                                prefetched)
+    quote = calculate_quote_tax(loaded, handelspris_input, norm_km_input)
+    return complete_quote(quote, eur_price, get_eur_exchange_rate())
+
+
+def print_quote_tax(quote):
+    print(f"Handelspris fra sheet: {quote['sheet_handelspris']} kr. for aldersgruppen {quote['age_group']}.")
+    print(f"\nType: {quote['vehicle_type']}")
+    if quote['vehicle_type'] == "Varebil":
+        print(f"Totalvægt: {quote['total_weight']} kg")
+    print(f"Køretøj: {quote['vehicle_info']}")
+    print(f"Nypris: {quote['new_price']:,.2f} kr.")
+    print(f"Eksportafgift: {quote['export_tax']:.2f} kr.")
+    print(f"Eksportafgift efter reduktion: {quote['reduced_tax']:.2f} kr.")
+
+
+def print_quote_total(quote):
+    print(f"\nEuro pris: {quote['eur_price']:,.2f} EUR")
+    print(f"Omregnet til DKK: {quote['dkk_converted']:,.2f} kr. (kurs {format_exchange_rate(quote['exchange_rate'])})")
+    print(f"Total sum (Reduktion + DKK): {quote['total_sum']:,.2f} kr.")
+    if quote['is_manual_price']:
+        print("Bemærk: KRÆVER DOBBELTTJEK")
+
+
+BATCH_OUTPUT_FIELDS = [
+    'row', 'status', 'error', 'registration_number', 'vehicle_type', 'vehicle_info', 'vehicle_age',
+    'handelspris_input', 'norm_km_input', 'current_km_input', 'sheet_handelspris', 'age_group',
+    'new_price', 'is_manual_price', 'export_tax', 'reduced_tax', 'eur_price', 'exchange_rate',
+    'exchange_rate_source', 'dkk_converted', 'total_sum'
+]
+
+
+def read_batch_rows(path):
+    # CSV eller JSONL med nummerplade, handelspris, norm_km, eur_pris og evt. km og nypris
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        if path.lower().endswith('.jsonl'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+
+def optional_float(value):
+    if value is None or str(value).strip() == '':
+        return None
+    return float(value)
+
+
+def quote_batch_row(index, row, api_token, hubspot_api_key, prefetched=None):
+    registration_number = str(row.get('nummerplade', '')).strip()
+    started = time.perf_counter()
+    metrics = start_quote_metrics()
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            entry_count = sum(1 for line in f if line.startswith('=== Log Entry'))
-    except FileNotFoundError:
-        entry_count = 0
-
-    log_entry = (
-        f"\n=== Log Entry #{entry_count + 1} - {datetime.now().strftime('%H:%M:%S')} ===\n"
-        f"1. Nummerplade: {registration_number}\n"
-        f"2. Type: {type}\n"
-        f"3. Køretøj: {vehicle_info}\n"
-        f"4. Indtastet handelspris: {handelspris_input:,.2f} kr.\n"
-        f"5. Norm kilometer: {norm_km_input:,} km\n"
-        f"6. Aktuelle kilometer: {current_km_input:} km\n"
-        f"7. Handelspris fra sheet: {sheet_handelspris:,.2f} kr. ({age_group})\n"
-        f"8. Nypris: {new_price:,.2f} kr.\n"
-        f"9. Eksportafgift: {export_tax:.2f} kr.\n"
-        f"10. Eksportafgift efter reduktion: {reduced_tax:.2f} kr.\n"
-        f"11. Euro pris: {eur_price:,.2f} EUR\n"
-        f"12. Omregnet til DKK: {dkk_converted:,.2f} kr.\n"
-        f"13. Total sum (Reduktion + DKK): {total_sum:,.2f} kr.\n"
-        f"{'=' * 50}\n"
+        result = quote_vehicle(
+            registration_number,
+            float(row['handelspris']),
+            float(row['norm_km']),
+            float(row['eur_pris']),
+            api_token,
+            hubspot_api_key,
+            current_km_input=optional_float(row.get('km')),
+            manual_price=optional_float(row.get('nypris')),
+            prefetched=prefetched
+        )
+    except Exception as e:
+        return {'row': index, 'status': 'fejl', 'error': str(e), 'registration_number': registration_number}, None
+
+    result['timings'] = finish_quote_metrics(metrics, started)
+    exchange_rate = result['exchange_rate']
+    output = dict(result, row=index, status='ok', error='',
+                  exchange_rate=exchange_rate['rate'], exchange_rate_source=exchange_rate['source'])
+    return output, result
+
+
+def log_quote_result(result):
+    return log_to_file(result['registration_number'], result['vehicle_type'], result['vehicle_info'],
+                       result['new_price'], result['export_tax'], result['reduced_tax'],
+                       result['handelspris_input'], result['norm_km_input'], result['current_km_input'],
+                       result['sheet_handelspris'], result['age_group'], result['eur_price'],
+                       result['dkk_converted'], result['total_sum'], result['exchange_rate'],
+                       is_manual_price=result['is_manual_price'], brand=result['brand'], model=result['model'],
+                       sources=result['sources'], timings=result['timings'],
+                       tax_inputs=result['tax_inputs'], km_fingerprint=result['km_fingerprint'])
+
+
+def read_batch_output_rows(path):
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        if path.lower().endswith('.jsonl'):
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Halv linje fra en afbrudt kørsel
+                    continue
+        else:
+            yield from csv.DictReader(file)
+
+
+def open_batch_writer(file, path, write_header):
+    if path.lower().endswith('.jsonl'):
+        def write(output):
+            file.write(json.dumps(output, ensure_ascii=False) + '\n')
+            file.flush()
+    else:
+        writer = csv.DictWriter(file, fieldnames=BATCH_OUTPUT_FIELDS, extrasaction='ignore')
+        if write_header:
+            writer.writeheader()
+
+        def write(output):
+            writer.writerow(output)
+            file.flush()
+    return write
+
+
+def open_batch_output(path, done):
+    # Ved genoptagelse skrives filen om med kun de rækker der står i checkpoint-filen, så
+    # fejlede rækker fra tidligere kørsler ikke optræder to gange
+    if done and os.path.exists(path):
+        kept = {}
+        for output in read_batch_output_rows(path):
+            try:
+                row = int(output.get('row'))
+            except (TypeError, ValueError):
+                continue
+            if row in done and output.get('status') == 'ok':
+                kept.setdefault(row, output)
+
+        temp_file = path + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8', newline='') as file:
+            write = open_batch_writer(file, path, write_header=True)
+            for output in kept.values():
+                write(output)
+        os.replace(temp_file, path)
+
+        file = open(path, 'a', encoding='utf-8', newline='')
+        return file, open_batch_writer(file, path, write_header=False)
+
+    file = open(path, 'w', encoding='utf-8', newline='')
+    return file, open_batch_writer(file, path, write_header=True)
+
+
+def prefetch_batch_data(input_path, done, api_token, hubspot_api_key):
+    # Slå køretøjsdata og kilometertal op for alle rækker i få samlede forespørgsler. Resultatet
+    # gives direkte til quote_vehicle pr. plade, så det også bruges med --no-cache og --refresh.
+    # Plader uden deal i HubSpot gives videre som None; kun plader fra fejlede opslag slås op
+    # igen enkeltvis af quote_vehicle.
+    prefetched = {}
+    registration_numbers = []
+    without_km = []
+    for index, row in enumerate(read_batch_rows(input_path), start=1):
+        if index in done:
+            continue
+        registration_number = str(row.get('nummerplade', '')).strip()
+        registration_numbers.append(registration_number)
+        if optional_float(row.get('km')) is None:
+            without_km.append(registration_number)
+
+    if registration_numbers:
+        vehicles = get_vehicle_records(registration_numbers, api_token)
+        print(f"Køretøjsdata fra Synsbasen: {len(vehicles)} af {len(set(registration_numbers))} plader fundet")
+        for key, vehicle in vehicles.items():
+            prefetched.setdefault(key, {})['vehicle'] = vehicle
+    if without_km:
+        mileages = get_hubspot_mileages(without_km, hubspot_api_key)
+        found = sum(1 for mileage in mileages.values() if mileage)
+        print(f"Kilometertal fra HubSpot: {found} af {len(set(without_km))} plader fundet")
+        for key, mileage in mileages.items():
+            prefetched.setdefault(key, {})['hubspot_mileage'] = mileage
+    return prefetched
+
+
+def run_batch(input_path, output_path, api_token, hubspot_api_key, workers=4):
+    # Beregnede rækker noteres i checkpoint-filen, så en afbrudt kørsel kan genoptages med
+    # samme kommando. Fejlede rækker noteres ikke og beregnes igen ved næste kørsel.
+    checkpoint_path = output_path + '.checkpoint'
+    done = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r', encoding='utf-8') as file:
+            done = {int(line) for line in file if line.strip()}
+        print(f"Genoptager: {len(done)} rækker er allerede beregnet")
+
+    prefetched = prefetch_batch_data(input_path, done, api_token, hubspot_api_key)
+    output_file, write_output = open_batch_output(output_path, done)
+    checkpoint_file = open(checkpoint_path, 'a', encoding='utf-8')
+    completed = failed = 0
+
+    def handle(future):
+        nonlocal completed, failed
+        output, result = future.result()
+        write_output(output)
+        if result is None:
+            failed += 1
+            print(f"Række {output['row']} ({output['registration_number']}): fejl - {output['error']}")
+            return
+        completed += 1
+        log_quote_result(result)
+        # Kun beregnede rækker noteres, så fejlede rækker prøves igen når kørslen genstartes
+        checkpoint_file.write(f"{output['row']}\n")
+        checkpoint_file.flush()
+        print(f"Række {output['row']} ({output['registration_number']}): total {output['total_sum']:,.2f} kr.")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch') as executor:
+            pending = set()
+            for index, row in enumerate(read_batch_rows(input_path), start=1):
+                if index in done:
+                    continue
+                # Begræns antallet af ventende rækker, så store filer ikke læses ind på én gang
+                if len(pending) >= workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        handle(future)
+                key = normalize_registration_number(str(row.get('nummerplade', '')).strip())
+                pending.add(executor.submit(quote_batch_row, index, row, api_token, hubspot_api_key,
+                                            prefetched.get(key)))
+
+            for future in pending:
+                handle(future)
+    finally:
+        output_file.close()
+        checkpoint_file.close()
+
+    print(f"\nBatch færdig: {completed} beregnet, {failed} fejlede. API-kald: {format_api_call_counts()}")
+    return completed, failed
+
+
+# Prisscenarier til forhandling. Køretøjsdata, nypris og afgift hentes én gang; derefter
+# regnes hele nettet af Euro priser, kurser og handelspriser i ét vektoriseret gennemløb.
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("Prisscenarier kræver numpy - installer det med: pip install numpy")
+    return numpy
+
+
+def parse_sweep_values(text):
+    # "100000:150000:10000" (start:slut:trin, inkl. slut) eller "7.44,7.46,7.48"
+    try:
+        if ':' in text:
+            start, stop, step = (float(part) for part in text.split(':'))
+            if step <= 0 or stop < start:
+                raise ValueError
+            count = int(round((stop - start) / step)) + 1
+            return [round(start + index * step, 6) for index in range(count)]
+        values = [float(part) for part in text.split(',') if part.strip()]
+        if not values:
+            raise ValueError
+        return values
+    except ValueError:
+        raise Exception(f"Ugyldigt interval: {text} (brug start:slut:trin eller en kommasepareret liste)")
+
+
+def calculate_reduced_tax_array(np, export_tax):
+    # Samme regel som calculate_reduced_tax, uden forgrening pr. element
+    return np.where(export_tax > REDUCED_TAX_THRESHOLD,
+                    export_tax * REDUCED_TAX_HIGH_RATE - REDUCED_TAX_HIGH_DEDUCTION,
+                    export_tax - REDUCED_TAX_LOW_DEDUCTION)
+
+
+def sweep_vehicle(registration_number, handelspris_values, norm_km_input, eur_values, rate_values,
+                  api_token, hubspot_api_key, current_km_input=None, manual_price=None, target=None):
+    np = import_numpy()
+    loaded = load_quote_vehicle(registration_number, api_token, hubspot_api_key, current_km_input, manual_price)
+    basic_data = loaded['basic']
+    new_price = float(loaded['new_price'])
+
+    # KM-arket slås op én gang pr. handelspris (og huskes af cachen til næste gang), og
+    # afgiften beregnes én gang pr. forskellig handelspris fra arket
+    sheets = get_sheets_service()
+    tax_inputs = build_tax_inputs(loaded['vehicle'])
+    sheet_prices = []
+    export_taxes = []
+    taxes_by_sheet_price = {}
+    for handelspris_input in handelspris_values:
+        trade_row = update_km_data(sheets, handelspris_input, norm_km_input, loaded['current_km_input'])
+        sheet_price, age_group = find_trade_price_based_on_age(trade_row, loaded['vehicle_age'])
+        if sheet_price not in taxes_by_sheet_price:
+            taxes_by_sheet_price[sheet_price] = calculate_export_tax(sheets, loaded['vehicle_type'], tax_inputs,
+                                                                     sheet_price, new_price)
+        sheet_prices.append(sheet_price)
+        export_taxes.append(taxes_by_sheet_price[sheet_price])
+
+    handelspris = np.array(handelspris_values, dtype=float)
+    sheet_price = np.array(sheet_prices, dtype=float)
+    eur = np.array(eur_values, dtype=float)
+    rate = np.array(rate_values, dtype=float)
+
+    export_tax = np.array(export_taxes, dtype=float)
+    reduced_tax = calculate_reduced_tax_array(np, export_tax)
+    # Akser: (Euro pris, kurs, handelspris)
+    dkk_converted = eur[:, None, None] * rate[None, :, None]
+    total_sum = reduced_tax[None, None, :] + dkk_converted
+    # Nulpunkt: den Euro pris hvor total sum svarer til målet (standard: handelsprisen)
+    target_sum = handelspris if target is None else np.full_like(handelspris, float(target))
+    break_even_eur = (target_sum[None, :] - reduced_tax[None, :]) / rate[:, None]
+
+    return {
+        'registration_number': registration_number,
+        'vehicle_info': build_vehicle_info(basic_data),
+        'age_group': age_group,
+        'new_price': new_price,
+        'handelspris': handelspris,
+        'sheet_price': sheet_price,
+        'export_tax': export_tax,
+        'reduced_tax': reduced_tax,
+        'eur': eur,
+        'rate': rate,
+        'total_sum': total_sum,
+        'target_sum': target_sum,
+        'break_even_eur': break_even_eur
+    }
+
+
+def iter_break_even_rows(sweep):
+    for rate_index, rate in enumerate(sweep['rate']):
+        for price_index, handelspris in enumerate(sweep['handelspris']):
+            yield {
+                'handelspris': float(handelspris),
+                'sheet_handelspris': float(sweep['sheet_price'][price_index]),
+                'kurs': float(rate),
+                'eksportafgift': float(sweep['export_tax'][price_index]),
+                'reduceret_afgift': float(sweep['reduced_tax'][price_index]),
+                'maal': float(sweep['target_sum'][price_index]),
+                'nulpunkt_eur': round(float(sweep['break_even_eur'][rate_index, price_index]), 2)
+            }
+
+
+def write_sweep_grid(sweep, path):
+    np = import_numpy()
+    eur, rate, handelspris = np.meshgrid(sweep['eur'], sweep['rate'], sweep['handelspris'], indexing='ij')
+    reduced_tax = np.broadcast_to(sweep['reduced_tax'], eur.shape)
+    margin = sweep['total_sum'] - np.broadcast_to(sweep['target_sum'], eur.shape)
+    columns = [eur.ravel(), rate.ravel(), handelspris.ravel(), reduced_tax.ravel(),
+               sweep['total_sum'].ravel(), margin.ravel()]
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['eur_pris', 'kurs', 'handelspris', 'reduceret_afgift', 'total_sum', 'margin'])
+        writer.writerows(zip(*(np.round(column, 2).tolist() for column in columns)))
+
+
+def run_sweep(args, api_token, hubspot_api_key):
+    rate_values = parse_sweep_values(args.kurs) if args.kurs else [get_todays_eur_exchange_rate()['rate']]
+    sweep = sweep_vehicle(normalize_registration_number(args.nummerplade), parse_sweep_values(args.handelspris),
+                          args.norm_km, parse_sweep_values(args.eur), rate_values, api_token, hubspot_api_key,
+                          current_km_input=args.km, manual_price=args.nypris, target=args.target)
+    if not args.csv:
+        print(f"{sweep['registration_number']}: {sweep['vehicle_info']}, nypris {sweep['new_price']:,.2f} kr., "
+              f"aldersgruppe {sweep['age_group']}")
+        print(f"{sweep['total_sum'].size} scenarier beregnet. Nulpunkt = Euro pris hvor total sum når målet:\n")
+    print_rows(iter_break_even_rows(sweep), args.csv)
+    if args.grid:
+        write_sweep_grid(sweep, args.grid)
+        if not args.csv:
+            print(f"\nAlle scenarier gemt i {args.grid}")
+
+
+# Tilbudsserver. Én langlivet proces ejer HTTP-sessioner, Sheets-klient og cacher, så
+# flere sælgere kan regne samtidig uden at overskrive hinandens input i arkene
+# (skriv-og-læs-forløbene serialiseres af SPREADSHEET_LOCKS). CLI'en bliver en tynd klient.
+QUOTE_SERVER_MAX_BODY = 64 * 1024
+
+
+def describe_vehicle(registration_number, api_token, hubspot_api_key):
+    # Det klienten skal vise og spørge om, før selve tilbuddet kan beregnes. Kører allerede i
+    # serverens egen tråd, så opslagene laves direkte i stedet for via den delte prefetch-pulje.
+    vehicle = get_vehicle_record(registration_number, api_token)
+    basic_data = vehicle['basic']
+    eval_data = parse_evaluation_data(vehicle['appraisals'])
+    return {
+        'registration_number': registration_number,
+        'vehicle_type': basic_data['type'],
+        'vehicle_info': build_vehicle_info(basic_data),
+        'vehicle_age': calculate_vehicle_age(basic_data['registration_date']),
+        'total_weight': vehicle['weight'].get('total_weight') or 0,
+        'new_price': calculate_new_price(eval_data),
+        'hubspot_km': get_hubspot_mileage(registration_number, hubspot_api_key)
+    }
+
+
+def parse_quote_request(body):
+    # Kun fejl her er klientens fejl (400); alt der fejler under selve beregningen er 500
+    try:
+        fields = json.loads(body or b'{}')
+    except ValueError as e:
+        raise ValueError(f"Ugyldig JSON: {e}")
+    if not isinstance(fields, dict):
+        raise ValueError("Forespørgslen skal være et JSON-objekt")
+
+    request = {}
+    for name in ['nummerplade', 'handelspris', 'norm_km', 'eur_pris', 'km', 'nypris']:
+        value = fields.get(name)
+        if name == 'nummerplade':
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError(f"Feltet '{name}' mangler")
+            request[name] = normalize_registration_number(value)
+            continue
+        try:
+            request[name] = optional_float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Feltet '{name}' skal være et tal")
+        # float() godtager "nan" og "inf", som hverken må skrives i arket eller i JSON-svaret
+        if request[name] is not None and not math.isfinite(request[name]):
+            raise ValueError(f"Feltet '{name}' skal være et tal")
+        if request[name] is None and name not in ('km', 'nypris'):
+            raise ValueError(f"Feltet '{name}' mangler")
+    return request
+
+
+def serve_quote(request, api_token, hubspot_api_key):
+    started = time.perf_counter()
+    metrics = start_quote_metrics()
+    result = quote_vehicle(
+        request['nummerplade'],
+        request['handelspris'],
+        request['norm_km'],
+        request['eur_pris'],
+        api_token,
+        hubspot_api_key,
+        current_km_input=request['km'],
+        manual_price=request['nypris']
     )
+    result['timings'] = finish_quote_metrics(metrics, started)
+    result['entry_number'] = log_quote_result(result)
+    return result
 
-    with open(filename, 'a', encoding='utf-8') as f:
-        f.write(log_entry)
 
+async def read_http_request(reader):
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > QUOTE_SERVER_MAX_BODY:
+        raise ValueError("Forespørgslen er for stor")
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def write_http_response(writer, status, payload):
+    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n")
+    writer.write(head.encode('latin-1') + data)
+
+
+async def dispatch_server_request(method, path, body, executor, api_token, hubspot_api_key):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    try:
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok', 'api_calls': get_api_call_counts(), 'cache': format_cache_stats()}
+        if method == 'GET' and path.startswith('/vehicle/'):
+            registration_number = normalize_registration_number(unquote(path[len('/vehicle/'):]))
+            return 200, await loop.run_in_executor(
+                executor, describe_vehicle, registration_number, api_token, hubspot_api_key)
+        if method == 'POST' and path == '/quote':
+            try:
+                request = parse_quote_request(body)
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            return 200, await loop.run_in_executor(executor, serve_quote, request, api_token, hubspot_api_key)
+        return 404, {'error': f"Ukendt adresse: {method} {path}"}
+    except Exception as e:
+        return 500, {'error': str(e)}
 
-def main():
-    config = load_config()
 
-    api_token = config['API_TOKEN']
+async def handle_server_connection(reader, writer, executor, api_token, hubspot_api_key):
+    import asyncio
+    try:
+        while True:
+            try:
+                request = await read_http_request(reader)
+            except ValueError as e:
+                write_http_response(writer, 400, {'error': str(e)})
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            status, payload = await dispatch_server_request(method, path, body, executor, api_token, hubspot_api_key)
+            write_http_response(writer, status, payload)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run_quote_server(host, port, api_token, hubspot_api_key, workers=8):
+    import asyncio
+    # Klienten og caches varmes op én gang for alle brugere
+    refresh_eur_exchange_rate_in_background()
+    get_prefetch_executor().submit(warm_sheets_service)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='server') as executor:
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_server_connection(reader, writer, executor, api_token, hubspot_api_key),
+            host, port)
+        print(f"Tilbudsserver kører på http://{host}:{port} ({workers} samtidige beregninger)")
+        async with server:
+            await server.serve_forever()
+
+
+def request_quote_server(method, url, **kwargs):
+    # Tilbud kan vente på arkene bag andre brugere, så læsetimeout er længere end normalt
+    response = http_request(method, url, timeout=(5, 120), max_attempts=1, **kwargs)
+    try:
+        payload = response.json()
+    except ValueError:
+        raise Exception(f"Uventet svar fra tilbudsserveren (status {response.status_code})")
+    if response.status_code != 200:
+        raise Exception(payload.get('error', f"Tilbudsserveren svarede {response.status_code}"))
+    return payload
+
 
+def run_client(server_url, show_timings=False):
+    # Samme dialog som main(), men al opslag og beregning sker på tilbudsserveren
     while True:
         try:
-            sheets = get_sheets_service()
-
-            # Spørg efter nummerplade
             registration_number = input("\nIndtast nummerplade (eller 'q' for at afslutte): ").strip()
-
-            # Check om brugeren vil afslutte
             if registration_number.lower() == 'q':
                 print("Afslutter programmet...")
                 break
-            print("Henter basis køretøjsdata...")
-            basic_data = fetch_basic_vehicle_data(registration_number, api_token)
-            vehicle_type = basic_data['type']
 
-            weight_data = fetch_weight_data(registration_number, api_token)
-            total_weight = weight_data.get('total_weight', 0)  # Brug 0 som default hvis ingen vægt findes
+            print("Henter køretøjsdata...")
+            vehicle = request_quote_server('GET', f"{server_url}/vehicle/{quote(registration_number)}")
+            print(f"Bilens alder: {vehicle['vehicle_age']} år")
+
+            fields = {
+                'nummerplade': registration_number,
+                'handelspris': float(input("Indtast handelsprisen: ")),
+                'norm_km': float(input("Indtast norm km: "))
+            }
+            if vehicle['hubspot_km']:
+                # km sendes ikke med, så serveren selv bruger HubSpot og logger kilden korrekt
+                print(f"Kilometertal hentet fra HubSpot: {float(vehicle['hubspot_km'])}")
+            else:
+                fields['km'] = float(input("Indtast bilens kørte kilometer: "))
+            if vehicle['new_price'] is None:
+                fields['nypris'] = input("Kunne ikke beregne nypris automatisk. Indtast manuel nypris: ")
+            fields['eur_pris'] = float(input("Indtast Euro pris: "))
+
+            result = request_quote_server('POST', f"{server_url}/quote", json=fields)
+            print_quote_tax(result)
+            print_quote_total(result)
+            print(f"Logget som tilbud #{result['entry_number']}")
+            if show_timings:
+                for stage, seconds in sorted(result['timings'].items(), key=lambda item: item[1], reverse=True):
+                    print(f"{stage:<16}{seconds:>10.3f}")
 
-            print("Henter evalueringsdata...")
-            eval_data = fetch_evaluation_data(registration_number, api_token)
+        except Exception as e:
+            print(f"Fejl: {e}")
+            time.sleep(2)
+            continue
 
-            vehicle_age = calculate_vehicle_age(basic_data['registration_date'])
-            print(f"Bilens alder: {vehicle_age} år")
 
-            handelspris_input = float(input("Indtast handelsprisen: "))
-            norm_km_input = float(input("Indtast norm km: "))
+# Struktureret tilbudslog. Hver beregning gemmes som en række i SQLite; den daglige
+# tekstlog skrives stadig, men løbenummeret kommer fra en tæller i databasen.
+QUOTE_LOG_FIELDS = [
+    'registration_number', 'vehicle_type', 'vehicle_info', 'brand', 'model', 'handelspris_input',
+    'norm_km_input', 'current_km_input', 'sheet_handelspris', 'age_group', 'new_price', 'is_manual_price',
+    'export_tax', 'reduced_tax', 'eur_price', 'exchange_rate', 'exchange_rate_source',
+    'exchange_rate_fetched_at', 'dkk_converted', 'total_sum', 'sources', 'timings', 'tax_inputs', 'km_fingerprint'
+]
+# Kolonner tilføjet efter den første version; ældre databaser udvides ved åbning
+QUOTE_LOG_ADDED_COLUMNS = [('tax_inputs', 'TEXT'), ('km_fingerprint', 'TEXT')]
+
+_quote_log_connection = None
+_quote_log_lock = threading.Lock()
+
+
+def get_quote_log_connection():
+    global _quote_log_connection
+    if _quote_log_connection is None:
+        os.makedirs(os.path.dirname(QUOTE_LOG_FILE) or '.', exist_ok=True)
+        # Autocommit, så transaktionerne styres eksplicit med BEGIN IMMEDIATE
+        connection = sqlite3.connect(QUOTE_LOG_FILE, timeout=30, check_same_thread=False, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        # WAL lader andre processer læse mens der skrives
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS quotes ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, log_date TEXT NOT NULL, entry_number INTEGER NOT NULL, "
+            "created_at TEXT NOT NULL, registration_number TEXT NOT NULL, vehicle_type TEXT, vehicle_info TEXT, "
+            "brand TEXT, model TEXT, handelspris_input REAL, norm_km_input REAL, current_km_input REAL, "
+            "sheet_handelspris REAL, age_group TEXT, new_price REAL, is_manual_price INTEGER, "
+            "export_tax REAL, reduced_tax REAL, eur_price REAL, exchange_rate REAL, exchange_rate_source TEXT, "
+            "exchange_rate_fetched_at TEXT, dkk_converted REAL, total_sum REAL, sources TEXT, timings TEXT, "
+            "tax_inputs TEXT, km_fingerprint TEXT)"
+        )
+        existing_columns = {row['name'] for row in connection.execute("PRAGMA table_info(quotes)")}
+        for column, column_type in QUOTE_LOG_ADDED_COLUMNS:
+            if column not in existing_columns:
+                connection.execute(f"ALTER TABLE quotes ADD COLUMN {column} {column_type}")
+        # Genberegninger gemmes ved siden af tilbuddene, så selve loggen forbliver uændret
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS quote_revisions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, quote_id INTEGER NOT NULL REFERENCES quotes (id), "
+            "repriced_at TEXT NOT NULL, changed TEXT NOT NULL, vals TEXT NOT NULL, "
+            "old_total REAL, new_total REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS quote_revisions_quote ON quote_revisions (quote_id, id)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS log_counters (log_date TEXT PRIMARY KEY, last_entry INTEGER NOT NULL)")
+        connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS quotes_entry ON quotes (log_date, entry_number)")
+        connection.execute("CREATE INDEX IF NOT EXISTS quotes_plate ON quotes (registration_number, log_date)")
+        connection.execute("CREATE INDEX IF NOT EXISTS quotes_brand_model ON quotes (brand, model)")
+        connection.execute("CREATE INDEX IF NOT EXISTS quotes_type ON quotes (vehicle_type, log_date)")
+        _quote_log_connection = connection
+    return _quote_log_connection
+
+
+def count_text_log_entries(log_date):
+    # Kun til den første post på en dag, så nummereringen fortsætter i en
+    # tekstlog der er skrevet før databasen blev taget i brug
+    connection = get_quote_log_connection()
+    if connection.execute("SELECT 1 FROM log_counters WHERE log_date = ?", (log_date,)).fetchone():
+        return 0
+    try:
+        with open(f"logs/vehicle_export_log_{log_date}.txt", 'r', encoding='utf-8') as f:
+            return sum(1 for line in f if line.startswith('=== Log Entry'))
+    except FileNotFoundError:
+        return 0
 
-            # Erstat den eksisterende kilometer-input linje med:
-            hubspot_km = fetch_hubspot_mileage(registration_number, config['HUBSPOT_API_KEY'])
-            if hubspot_km:
-                current_km_input = float(hubspot_km)
-                print(f"Kilometertal hentet fra HubSpot: {current_km_input}")
+
+def write_quote_log(entry):
+    # Løbenummeret for dagen tælles op i samme transaktion som indsættelsen, så
+    # samtidige skrivere (tråde eller processer) aldrig får samme nummer
+    with _quote_log_lock:
+        connection = get_quote_log_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT INTO log_counters (log_date, last_entry) VALUES (?, ?) "
+                "ON CONFLICT(log_date) DO UPDATE SET last_entry = last_entry + 1",
+                (entry['log_date'], count_text_log_entries(entry['log_date']) + 1)
+            )
+            entry['entry_number'] = connection.execute(
+                "SELECT last_entry FROM log_counters WHERE log_date = ?", (entry['log_date'],)
+            ).fetchone()[0]
+            columns = ['log_date', 'entry_number', 'created_at'] + QUOTE_LOG_FIELDS
+            connection.execute(
+                f"INSERT INTO quotes ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [entry[column] for column in columns]
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+    return entry['entry_number']
+
+
+def render_quote_log_entry(entry):
+    exchange_rate = {
+        'rate': entry['exchange_rate'],
+        'source': entry['exchange_rate_source'],
+        'fetched_at': entry['exchange_rate_fetched_at']
+    }
+    return (
+        f"\n=== Log Entry #{entry['entry_number']} - {entry['created_at'][11:19]} ===\n"
+        f"1. Nummerplade: {entry['registration_number']}\n"
+        f"2. Type: {entry['vehicle_type']}\n"
+        f"3. Køretøj: {entry['vehicle_info']}\n"
+        f"4. Indtastet handelspris: {entry['handelspris_input']:,.2f} kr.\n"
+        f"5. Norm kilometer: {entry['norm_km_input']:,} km\n"
+        f"6. Aktuelle kilometer: {entry['current_km_input']:} km\n"
+        f"7. Handelspris fra sheet: {entry['sheet_handelspris']:,.2f} kr. ({entry['age_group']})\n"
+        f"8. Nypris: {entry['new_price']:,.2f} kr.\n"
+        f"9. Eksportafgift: {entry['export_tax']:.2f} kr.\n"
+        f"10. Eksportafgift efter reduktion: {entry['reduced_tax']:.2f} kr.\n"
+        f"11. Euro pris: {entry['eur_price']:,.2f} EUR\n"
+        f"12. Omregnet til DKK: {entry['dkk_converted']:,.2f} kr.\n"
+        f"13. Total sum (Reduktion + DKK): {entry['total_sum']:,.2f} kr.\n"
+        f"14. Valutakurs EUR/DKK: {format_exchange_rate(exchange_rate)}\n"
+        f"{'=' * 50}\n"
+    )
+
+
+def render_quote_log(log_date):
+    # Tekstvisning af en dags tilbud direkte fra databasen
+    connection = get_quote_log_connection()
+    rows = connection.execute(
+        "SELECT * FROM quotes WHERE log_date = ? ORDER BY entry_number", (log_date,))
+    for row in rows:
+        yield render_quote_log_entry(dict(row))
+
+
+QUOTE_QUERY_COLUMNS = [
+    'log_date', 'entry_number', 'registration_number', 'vehicle_type', 'vehicle_info', 'age_group',
+    'new_price', 'is_manual_price', 'export_tax', 'reduced_tax', 'eur_price', 'exchange_rate', 'total_sum'
+]
+QUOTE_GROUP_COLUMNS = ['brand', 'model', 'vehicle_type', 'age_group', 'log_date', 'registration_number']
+
+
+def build_quote_filters(plate=None, date_from=None, date_to=None, brand=None, model=None,
+                        vehicle_type=None, manual_only=False):
+    conditions = []
+    params = []
+    if plate:
+        conditions.append("registration_number = ?")
+        params.append(normalize_registration_number(plate))
+    if date_from:
+        conditions.append("log_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("log_date <= ?")
+        params.append(date_to)
+    if brand:
+        conditions.append("brand = ? COLLATE NOCASE")
+        params.append(brand)
+    if model:
+        conditions.append("model = ? COLLATE NOCASE")
+        params.append(model)
+    if vehicle_type:
+        conditions.append("vehicle_type = ? COLLATE NOCASE")
+        params.append(vehicle_type)
+    if manual_only:
+        conditions.append("is_manual_price = 1")
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+
+def query_quotes(filters):
+    # Rækkerne hentes løbende fra databasen, så store perioder ikke lægges i hukommelsen
+    where, params = filters
+    cursor = get_quote_log_connection().execute(
+        f"SELECT {', '.join(QUOTE_QUERY_COLUMNS)} FROM quotes{where} ORDER BY log_date, entry_number", params)
+    for row in cursor:
+        yield dict(row)
+
+
+def aggregate_quotes(filters, group_by):
+    if group_by not in QUOTE_GROUP_COLUMNS:
+        raise Exception(f"Kan ikke gruppere på {group_by}")
+    where, params = filters
+    cursor = get_quote_log_connection().execute(
+        f"SELECT {group_by}, COUNT(*) AS antal, AVG(export_tax) AS gns_eksportafgift, "
+        f"AVG(reduced_tax) AS gns_reduceret_afgift, AVG(total_sum) AS gns_total, "
+        f"COALESCE(SUM(is_manual_price = 1), 0) AS manuel_nypris "
+        f"FROM quotes{where} GROUP BY {group_by} ORDER BY {group_by}", params)
+    for row in cursor:
+        yield dict(row)
+
+
+def print_rows(rows, as_csv=False, empty_message="Ingen tilbud fundet"):
+    writer = None
+    for row in rows:
+        if writer is None:
+            if as_csv:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(row))
+                writer.writeheader()
             else:
-                current_km_input = float(input("Indtast bilens kørte kilometer: "))
+                writer = True
+                print(" | ".join(row))
+        if as_csv:
+            writer.writerow(row)
+        else:
+            print(" | ".join(f"{value:,.2f}" if isinstance(value, float) else str(value) for value in row.values()))
+    if writer is None:
+        print(empty_message)
 
-            update_km_data(sheets, handelspris_input, norm_km_input, current_km_input)
-            handelspris, age_group = find_trade_price_based_on_age(sheets, vehicle_age)
-            print(f"Handelspris fra sheet: {handelspris} kr. for aldersgruppen {age_group}.")
 
-            # Find dette sted i koden hvor new_price beregnes
-            new_price = calculate_new_price(eval_data)
-            is_manual_price = False  # Tilføj denne variabel
+TEXT_LOG_HEADER = re.compile(r'^=== Log Entry #(\d+) - (\d{2}:\d{2}:\d{2}) ===$')
+TEXT_LOG_LINE = re.compile(r'^(\d+)\. [^:]+: (.*)$')
 
-            if new_price is None:
-                manual_price = input("Kunne ikke beregne nypris automatisk. Indtast manuel nypris: ")
-                new_price = calculate_new_price(eval_data, manual_price)
-                is_manual_price = True  # Sæt til True når manuel pris er indtastet
 
-            engine_data = fetch_engine_data(registration_number, api_token)
-            update_co2_in_sheets(sheets, engine_data['fuel_type'], engine_data['fuel_efficiency'],
-                                 basic_data['registration_date'], vehicle_type)
+def parse_text_log_number(value):
+    return float(re.sub(r'[^\d.\-]', '', value.split(' ')[0].replace(',', '')))
 
-            update_vehicle_data(sheets, vehicle_type, total_weight, handelspris, new_price)
 
-            # I main-funktionen
-            registration_tax = eval_data['registration_tax']
-            export_tax = get_export_tax(sheets, vehicle_type, registration_tax)
+def parse_text_log(path):
+    # Læser en gammel tekstlog linje for linje og giver én post ad gangen
+    log_date = re.search(r'(\d{4}-\d{2}-\d{2})', os.path.basename(path)).group(1)
+    entry = None
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.rstrip('\n')
+            header = TEXT_LOG_HEADER.match(line)
+            if header:
+                entry = {'log_date': log_date, 'entry_number': int(header.group(1)),
+                         'created_at': f"{log_date}T{header.group(2)}", 'fields': {}}
+                continue
+            if entry is None:
+                continue
+            if line.startswith('=' * 10):
+                yield entry
+                entry = None
+                continue
+            field = TEXT_LOG_LINE.match(line)
+            if field:
+                entry['fields'][int(field.group(1))] = field.group(2)
+
+
+def text_log_entry_to_row(entry):
+    fields = entry['fields']
+    trade_price = re.match(r'^(.*) kr\. \((.*)\)$', fields[7])
+    vehicle_info = fields[3]
+    exchange_rate = None
+    exchange_rate_source = None
+    if 14 in fields:
+        exchange_rate = parse_text_log_number(fields[14])
+        source = re.search(r'\((\w+)', fields[14])
+        exchange_rate_source = source.group(1) if source else None
+    return {
+        'log_date': entry['log_date'],
+        'entry_number': entry['entry_number'],
+        'created_at': entry['created_at'],
+        'registration_number': normalize_registration_number(fields[1]),
+        'vehicle_type': fields[2],
+        'vehicle_info': vehicle_info,
+        # Tekstloggen har kun den samlede beskrivelse; mærket er første ord
+        'brand': vehicle_info.split(' ')[0] if vehicle_info else None,
+        'model': None,
+        'handelspris_input': parse_text_log_number(fields[4]),
+        'norm_km_input': parse_text_log_number(fields[5]),
+        'current_km_input': parse_text_log_number(fields[6]),
+        'sheet_handelspris': parse_text_log_number(trade_price.group(1)),
+        'age_group': trade_price.group(2),
+        'new_price': parse_text_log_number(fields[8]),
+        # Ikke registreret i tekstloggen
+        'is_manual_price': None,
+        'export_tax': parse_text_log_number(fields[9]),
+        'reduced_tax': parse_text_log_number(fields[10]),
+        'eur_price': parse_text_log_number(fields[11]),
+        'exchange_rate': exchange_rate,
+        'exchange_rate_source': exchange_rate_source,
+        'exchange_rate_fetched_at': None,
+        'dkk_converted': parse_text_log_number(fields[12]),
+        'total_sum': parse_text_log_number(fields[13]),
+        'sources': json.dumps({'import': 'tekstlog'}),
+        'timings': json.dumps({}),
+        'tax_inputs': None,
+        'km_fingerprint': None
+    }
 
-            brand = basic_data.get('brand', 'N/A')
-            model = basic_data.get('model', 'N/A')
-            version = basic_data.get('version', 'N/A')
-            fuel_type = basic_data.get('fuel_type', 'N/A')
-            vehicle_info = f"{brand} {model} {version} {fuel_type}"
 
-            print(f"\nType: {vehicle_type}")
-            if vehicle_type == "Varebil":
-                print(f"Totalvægt: {total_weight} kg")
-            print(f"Køretøj: {vehicle_info}")
-            print(f"Nypris: {new_price:,.2f} kr.")
-            print(f"Eksportafgift: {export_tax:.2f} kr.")
-            reduced_tax = (export_tax * 0.85 - 3000) if export_tax > 50000 else export_tax - 11000
+def import_text_logs(paths):
+    # Engangsimport af logs/*.txt. Poster der allerede findes (samme dato og nummer) springes over.
+    columns = ['log_date', 'entry_number', 'created_at'] + QUOTE_LOG_FIELDS
+    imported = skipped = failed = 0
+    with _quote_log_lock:
+        connection = get_quote_log_connection()
+        for path in paths:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for entry in parse_text_log(path):
+                    try:
+                        row = text_log_entry_to_row(entry)
+                    except (KeyError, AttributeError, ValueError):
+                        failed += 1
+                        continue
+                    cursor = connection.execute(
+                        f"INSERT OR IGNORE INTO quotes ({', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' for _ in columns)})",
+                        [row[column] for column in columns]
+                    )
+                    if cursor.rowcount:
+                        imported += 1
+                    else:
+                        skipped += 1
+                    # Nye poster må ikke få et nummer der allerede er brugt
+                    connection.execute(
+                        "INSERT INTO log_counters (log_date, last_entry) VALUES (?, ?) "
+                        "ON CONFLICT(log_date) DO UPDATE SET last_entry = MAX(last_entry, excluded.last_entry)",
+                        (row['log_date'], row['entry_number'])
+                    )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+    print(f"Importeret {imported} poster, {skipped} fandtes allerede, {failed} kunne ikke læses")
+    return imported
+
+
+# Genberegning af gemte tilbud. Hver gemt værdi afhænger af bestemte upstream-input; når et
+# input ændres (kurs, KM-arkets handelspris-række eller afgiftsberegningen), genberegnes kun
+# de værdier der ligger nedstrøms, og kun for de tilbud hvor inputtet faktisk er ændret.
+REPRICE_STAGES = [
+    # (værdi, hvad den afhænger af) i beregningsrækkefølge
+    ('sheet_handelspris', {'trade_row'}),
+    ('export_tax', {'sheet_handelspris', 'tax'}),
+    ('reduced_tax', {'export_tax'}),
+    ('dkk_converted', {'exchange_rate'}),
+    ('total_sum', {'reduced_tax', 'dkk_converted'})
+]
+REPRICE_VALUE_FIELDS = ['sheet_handelspris', 'export_tax', 'reduced_tax', 'exchange_rate', 'dkk_converted',
+                        'total_sum', 'km_fingerprint']
+
+
+def load_quote_revision(quote):
+    # Seneste gemte genberegning er udgangspunktet, ellers det oprindelige tilbud
+    row = get_quote_log_connection().execute(
+        "SELECT vals FROM quote_revisions WHERE quote_id = ? ORDER BY id DESC LIMIT 1", (quote['id'],)
+    ).fetchone()
+    if row:
+        quote.update(json.loads(row['vals']))
+    return quote
+
+
+def find_changed_inputs(quote, exchange_rate, km_fingerprint, check_trade, check_tax):
+    changed = set()
+    if exchange_rate is not None and quote['exchange_rate'] != exchange_rate:
+        changed.add('exchange_rate')
+    # Med check_trade læses handelspris-rækken for alle tilbud. Ellers kun hvor KM-arket er ændret
+    # siden tilbuddet; tilbud uden gemt fingeraftryk (fx importeret fra tekstlog) springes over
+    stale = quote['km_fingerprint'] != km_fingerprint
+    if check_trade or (km_fingerprint and quote['km_fingerprint'] and stale):
+        changed.add('trade_row')
+    if check_tax:
+        changed.add('tax')
+    return changed
+
+
+def reprice_quote(quote, changed_inputs, compute):
+    values = dict(quote)
+    changed = set(changed_inputs)
+    for name, dependencies in REPRICE_STAGES:
+        if changed & dependencies:
+            new_value = compute[name](values)
+            if new_value is None or round(new_value, 2) != round(values[name] or 0, 2):
+                values[name] = new_value
+                changed.add(name)
+    return values, sorted(changed & {name for name, _ in REPRICE_STAGES})
+
+
+def build_reprice_computations(exchange_rate, api_token, refresh_trade=False):
+    trade_rows = {}
+
+    def trade_row(values):
+        key = (values['handelspris_input'], values['norm_km_input'], values['current_km_input'])
+        if key not in trade_rows:
+            trade_rows[key] = update_km_data(get_sheets_service(), *key, refresh=refresh_trade)
+        return trade_rows[key]
+
+    def export_tax(values):
+        if values['tax_inputs']:
+            tax_inputs = json.loads(values['tax_inputs'])
+        else:
+            # Ældre tilbud har ikke afgiftsgrundlaget gemt; det hentes (helst fra cachen)
+            tax_inputs = build_tax_inputs(get_vehicle_record(values['registration_number'], api_token))
+        return calculate_export_tax(get_sheets_service(), values['vehicle_type'], tax_inputs,
+                                    values['sheet_handelspris'], values['new_price'])
+
+    return {
+        'sheet_handelspris': lambda values: trade_price_for_age_group(trade_row(values), values['age_group']),
+        'export_tax': export_tax,
+        'reduced_tax': lambda values: calculate_reduced_tax(values['export_tax']),
+        'dkk_converted': lambda values: values['eur_price'] * exchange_rate,
+        'total_sum': lambda values: values['reduced_tax'] + values['dkk_converted']
+    }
 
-            print(f"Eksportafgift efter reduktion: {reduced_tax:.2f} kr.")
 
-            # Derefter håndter euro-beregninger
-            eur_price = float(input("Indtast Euro pris: "))
-            exchange_rate = get_eur_exchange_rate()
-            dkk_converted = eur_price * exchange_rate
-            total_sum = reduced_tax + dkk_converted
+def reprice_quotes(filters, api_token, exchange_rate=None, check_trade=False, check_tax=False, save=False):
+    # Giver en række pr. tilbud hvis total er ændret; gemmes kun med save=True
+    if exchange_rate is None:
+        exchange_rate = get_todays_eur_exchange_rate()['rate']
+    reset_api_call_counts()
+    # Med check_trade læses fingeraftrykket og alle handelspris-rækker direkte fra arket. Ellers
+    # bruges fingeraftrykket fra cachen, og det hentes kun hvis det er udløbet
+    km_fingerprint = None
+    if _cache_mode != 'off':
+        km_fingerprint = get_km_sheet_fingerprint(get_sheets_service(), refresh=check_trade)
+    compute = build_reprice_computations(exchange_rate, api_token, refresh_trade=check_trade)
+
+    where, params = filters
+    quotes = get_quote_log_connection().execute(
+        f"SELECT * FROM quotes{where} ORDER BY log_date, entry_number", params).fetchall()
+    revisions = []
+    checked = failed = updated = 0
+    for row in quotes:
+        quote = load_quote_revision(dict(row))
+        checked += 1
+        changed_inputs = find_changed_inputs(quote, exchange_rate, km_fingerprint, check_trade, check_tax)
+        if not changed_inputs:
+            continue
+        try:
+            values, changed = reprice_quote(quote, changed_inputs, compute)
+        except Exception as e:
+            failed += 1
+            print(f"{quote['registration_number']} ({quote['log_date']} #{quote['entry_number']}): fejl - {e}")
+            continue
+        values['exchange_rate'] = exchange_rate
+        if 'trade_row' in changed_inputs and km_fingerprint:
+            values['km_fingerprint'] = km_fingerprint
+        if not changed:
+            # Samme total, men ny kurs eller nyt fingeraftryk gemmes, så tilbuddet ikke tjekkes igen
+            if values['exchange_rate'] != quote['exchange_rate'] or values['km_fingerprint'] != quote['km_fingerprint']:
+                revisions.append((quote, values, changed))
+            continue
+        revisions.append((quote, values, changed))
+        updated += 1
+        yield {
+            'dato': quote['log_date'],
+            'nr': quote['entry_number'],
+            'nummerplade': quote['registration_number'],
+            'aendret': ', '.join(changed),
+            'gammel_total': round(quote['total_sum'], 2),
+            'ny_total': round(values['total_sum'], 2),
+            'forskel': round(values['total_sum'] - quote['total_sum'], 2)
+        }
 
-            # Print euro-relaterede værdier
-            print(f"\nEuro pris: {eur_price:,.2f} EUR")
-            print(f"Omregnet til DKK: {dkk_converted:,.2f} kr.")
-            print(f"Total sum (Reduktion + DKK): {total_sum:,.2f} kr.")
+    if save and revisions:
+        save_quote_revisions(revisions)
+    print(f"\n{updated} af {checked} tilbud ændret, {failed} fejlede"
+          f"{' (gemt)' if save and revisions else ''}. API-kald: {format_api_call_counts()}", file=sys.stderr)
 
-            if is_manual_price:
-                print("Bemærk: KRÆVER DOBBELTTJEK")
 
-            # Log alle værdier
-            log_to_file(registration_number, vehicle_type, vehicle_info, new_price,
-                        export_tax, reduced_tax, handelspris_input, norm_km_input,
-                        current_km_input, handelspris, age_group, eur_price,
-                        dkk_converted, total_sum)
+def save_quote_revisions(revisions):
+    repriced_at = datetime.now().isoformat(timespec='seconds')
+    with _quote_log_lock:
+        connection = get_quote_log_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT INTO quote_revisions (quote_id, repriced_at, changed, vals, old_total, new_total) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(quote['id'], repriced_at, json.dumps(changed),
+                  json.dumps({field: values[field] for field in REPRICE_VALUE_FIELDS}),
+                  quote['total_sum'], values['total_sum']) for quote, values, changed in revisions]
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+
+def log_to_file(registration_number, type, vehicle_info, new_price, export_tax, reduced_tax, handelspris_input, norm_km_input, current_km_input, sheet_handelspris, age_group, eur_price, dkk_converted, total_sum, exchange_rate,
+                is_manual_price=False, brand=None, model=None, sources=None, timings=None,
+                tax_inputs=None, km_fingerprint=None):
+    now = datetime.now()
+    entry = {
+        'log_date': now.strftime('%Y-%m-%d'),
+        'created_at': now.isoformat(timespec='seconds'),
+        'registration_number': normalize_registration_number(registration_number),
+        'vehicle_type': type,
+        'vehicle_info': vehicle_info,
+        'brand': brand,
+        'model': model,
+        'handelspris_input': handelspris_input,
+        'norm_km_input': norm_km_input,
+        'current_km_input': current_km_input,
+        'sheet_handelspris': sheet_handelspris,
+        'age_group': age_group,
+        'new_price': new_price,
+        'is_manual_price': int(bool(is_manual_price)),
+        'export_tax': export_tax,
+        'reduced_tax': reduced_tax,
+        'eur_price': eur_price,
+        'exchange_rate': exchange_rate['rate'],
+        'exchange_rate_source': exchange_rate['source'],
+        'exchange_rate_fetched_at': exchange_rate['fetched_at'],
+        'dkk_converted': dkk_converted,
+        'total_sum': total_sum,
+        'sources': json.dumps(sources or {}),
+        'timings': json.dumps(timings or {}),
+        'tax_inputs': json.dumps(tax_inputs) if tax_inputs else None,
+        'km_fingerprint': km_fingerprint
+    }
+    entry_number = write_quote_log(entry)
+
+    # Den læsbare tekstlog skrives stadig, men uden at læse filen igennem
+    filename = f"logs/vehicle_export_log_{entry['log_date']}.txt"
+    os.makedirs('logs', exist_ok=True)
+    with open(filename, 'a', encoding='utf-8') as f:
+        f.write(render_quote_log_entry(entry))
+    return entry_number
+
 
+def main(show_timings=False):
+    api_token = config['API_TOKEN']
+    # Hent dagens kurs og gør Sheets-klienten klar mens operatøren taster
+    refresh_eur_exchange_rate_in_background()
+    get_prefetch_executor().submit(warm_sheets_service)
+
+    while True:
+        try:
+            # Spørg efter nummerplade
+            registration_number = input("\nIndtast nummerplade (eller 'q' for at afslutte): ").strip()
+
+            # Check om brugeren vil afslutte
+            if registration_number.lower() == 'q':
+                print("Afslutter programmet...")
+                break
+            reset_api_call_counts()
+            quote_started = time.perf_counter()
+            metrics = start_quote_metrics()
+            prefetch = start_prefetch(registration_number, api_token, config['HUBSPOT_API_KEY'], metrics)
+            print("Henter køretøjsdata...")
+            vehicle = prefetch['vehicle'].result()
+            # Mangler vurderingsdata, fejler tilbuddet her - før operatøren har tastet noget
+            needs_manual_price = calculate_new_price(parse_evaluation_data(vehicle['appraisals'])) is None
+            print(f"Bilens alder: {calculate_vehicle_age(vehicle['basic']['registration_date'])} år")
+
+            handelspris_input = float(timed_input("Indtast handelsprisen: ", metrics))
+            norm_km_input = float(timed_input("Indtast norm km: ", metrics))
+
+            hubspot_km = prefetch['hubspot_mileage'].result()
+            current_km_input = None
+            if hubspot_km:
+                print(f"Kilometertal hentet fra HubSpot: {float(hubspot_km)}")
+            else:
+                current_km_input = float(timed_input("Indtast bilens kørte kilometer: ", metrics))
+
+            manual_price = None
+            if needs_manual_price:
+                manual_price = timed_input("Kunne ikke beregne nypris automatisk. Indtast manuel nypris: ", metrics)
 
+            loaded = load_quote_vehicle(registration_number, api_token, config['HUBSPOT_API_KEY'],
+                                        current_km_input, manual_price,
+                                        prefetched={'vehicle': vehicle, 'hubspot_mileage': hubspot_km})
+            quote = calculate_quote_tax(loaded, handelspris_input, norm_km_input, prefetch['sheets'].result())
+            print_quote_tax(quote)
 
+            # Derefter håndter euro-beregninger
+            eur_price = float(timed_input("Indtast Euro pris: ", metrics))
+            complete_quote(quote, eur_price, prefetch['exchange_rate'].result())
+            print_quote_total(quote)
 
+            print(f"API-kald for dette tilbud: {format_api_call_counts()}")
+            print(f"Cache: {format_cache_stats()}")
+            quote['timings'] = finish_quote_metrics(metrics, quote_started)
+            if show_timings:
+                print(format_quote_metrics(metrics))
 
+            # Log alle værdier
+            log_quote_result(quote)
 
         except Exception as e:
             print(f"Fejl: {e}")
             time.sleep(2)
             continue
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Beregner eksportpris for køretøjer")
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument('--no-cache', action='store_true', help="Brug ikke den lokale cache")
+    cache_group.add_argument('--refresh', action='store_true', help="Hent alt på ny og opdater cachen")
+    parser.add_argument('--timings', action='store_true', help="Vis tidsforbrug pr. trin efter hvert tilbud")
+    parser.add_argument('--profile', action='store_true', help="Kør under cProfile og gem profilen")
+    parser.add_argument('--server', default=QUOTE_SERVER_URL,
+                        help="Beregn via tilbudsserveren på denne adresse (standard: QUOTE_SERVER_URL)")
+    subparsers = parser.add_subparsers(dest='command')
+
+    verify_parser = subparsers.add_parser(
+        'verify-tax', help="Sammenlign lokal afgiftsberegning med afgiftsarket")
+    verify_parser.add_argument('input', help="CSV med kolonnerne nummerplade, handelspris og evt. nypris")
+    verify_parser.add_argument('--tolerance', type=float, default=1.0, help="Tilladt forskel i kr.")
+
+    batch_parser = subparsers.add_parser('batch', help="Beregn tilbud for alle rækker i en CSV/JSONL-fil")
+    batch_parser.add_argument('input', help="CSV/JSONL med nummerplade, handelspris, norm_km, eur_pris og evt. km, nypris")
+    batch_parser.add_argument('output', help="Resultatfil (.csv eller .jsonl)")
+    batch_parser.add_argument('--workers', type=int, default=4, help="Antal samtidige beregninger")
+
+    sweep_parser = subparsers.add_parser('sweep', help="Beregn prisscenarier for én bil over intervaller af priser og kurser")
+    sweep_parser.add_argument('nummerplade')
+    sweep_parser.add_argument('--handelspris', required=True, help="Handelspriser, fx 100000:150000:10000")
+    sweep_parser.add_argument('--eur', required=True, help="Euro priser, fx 8000:14000:500")
+    sweep_parser.add_argument('--kurs', help="EUR/DKK-kurser, fx 7.44:7.47:0.01 (standard: dagens kurs)")
+    sweep_parser.add_argument('--norm-km', type=float, required=True, help="Norm km")
+    sweep_parser.add_argument('--km', type=float, help="Kørte kilometer (standard: fra HubSpot)")
+    sweep_parser.add_argument('--nypris', type=float, help="Manuel nypris hvis den ikke kan beregnes")
+    sweep_parser.add_argument('--target', type=float, help="Beløb total sum skal nå (standard: handelsprisen)")
+    sweep_parser.add_argument('--csv', action='store_true', help="Skriv nulpunkterne som CSV")
+    sweep_parser.add_argument('--grid', help="Gem alle scenarier i denne CSV-fil")
+
+    serve_parser = subparsers.add_parser('serve', help="Start den fælles tilbudsserver for flere brugere")
+    serve_parser.add_argument('--host', default=QUOTE_SERVER_HOST, help="Adresse serveren lytter på")
+    serve_parser.add_argument('--port', type=int, default=QUOTE_SERVER_PORT, help="Port serveren lytter på")
+    serve_parser.add_argument('--workers', type=int, default=8, help="Antal samtidige beregninger")
+
+    query_parser = subparsers.add_parser('query', help="Søg i tidligere tilbud")
+    query_parser.add_argument('--plate', help="Nummerplade")
+    query_parser.add_argument('--from', dest='date_from', help="Fra dato (ÅÅÅÅ-MM-DD)")
+    query_parser.add_argument('--to', dest='date_to', help="Til dato (ÅÅÅÅ-MM-DD)")
+    query_parser.add_argument('--brand', help="Mærke")
+    query_parser.add_argument('--model', help="Model")
+    query_parser.add_argument('--type', dest='vehicle_type', help="Køretøjstype, fx Varebil")
+    query_parser.add_argument('--manual', action='store_true', help="Kun tilbud med manuel nypris (KRÆVER DOBBELTTJEK)")
+    query_parser.add_argument('--group-by', choices=QUOTE_GROUP_COLUMNS, help="Vis gennemsnit pr. gruppe")
+    query_parser.add_argument('--csv', action='store_true', help="Skriv resultatet som CSV")
+
+    reprice_parser = subparsers.add_parser('reprice', help="Genberegn gemte tilbud efter ændret kurs eller ark")
+    reprice_parser.add_argument('--plate', help="Nummerplade")
+    reprice_parser.add_argument('--from', dest='date_from', help="Fra dato (ÅÅÅÅ-MM-DD)")
+    reprice_parser.add_argument('--to', dest='date_to', help="Til dato (ÅÅÅÅ-MM-DD)")
+    reprice_parser.add_argument('--kurs', type=float, help="EUR/DKK-kurs (standard: dagens kurs)")
+    reprice_parser.add_argument('--trade', action='store_true',
+                                help="Læs handelspris-rækken igen for alle tilbud, ikke kun hvor KM-arket er ændret")
+    reprice_parser.add_argument('--tax', action='store_true', help="Beregn eksportafgiften igen (fx efter ændret afgiftsark)")
+    reprice_parser.add_argument('--save', action='store_true', help="Gem de nye værdier som udgangspunkt for næste genberegning")
+    reprice_parser.add_argument('--csv', action='store_true', help="Skriv forskellene som CSV")
+
+    import_parser = subparsers.add_parser('import-logs', help="Importer gamle tekstlogs til tilbudsdatabasen")
+    import_parser.add_argument('paths', nargs='*', help="Logfiler (standard: logs/vehicle_export_log_*.txt)")
+
+    subparsers.add_parser('metrics', help="Vis p50/p95 tidsforbrug pr. trin")
+
+    log_parser = subparsers.add_parser('log', help="Vis en dags tilbudslog som tekst")
+    log_parser.add_argument('--date', default=datetime.now().strftime('%Y-%m-%d'), help="Dato (ÅÅÅÅ-MM-DD)")
+
+    verify_co2_parser = subparsers.add_parser(
+        'verify-co2', help="Sammenlign lokal CO2-omregning med \"Værktøj til CO2\"")
+    verify_co2_parser.add_argument('input', help="CSV med kolonnen nummerplade")
+    verify_co2_parser.add_argument('--tolerance', type=float, default=1.0, help="Tilladt forskel i g/km")
+
+    return parser.parse_args()
+
+
+def run_command(args):
+    if args.command == 'batch':
+        run_batch(args.input, args.output, config['API_TOKEN'], config['HUBSPOT_API_KEY'], args.workers)
+    elif args.command == 'sweep':
+        run_sweep(args, config['API_TOKEN'], config['HUBSPOT_API_KEY'])
+    elif args.command == 'serve':
+        import asyncio
+        asyncio.run(run_quote_server(args.host, args.port, config['API_TOKEN'], config['HUBSPOT_API_KEY'],
+                                     args.workers))
+    elif args.command == 'query':
+        filters = build_quote_filters(args.plate, args.date_from, args.date_to, args.brand, args.model,
+                                      args.vehicle_type, args.manual)
+        if args.group_by:
+            print_rows(aggregate_quotes(filters, args.group_by), args.csv)
+        else:
+            print_rows(query_quotes(filters), args.csv)
+    elif args.command == 'reprice':
+        filters = build_quote_filters(args.plate, args.date_from, args.date_to)
+        print_rows(reprice_quotes(filters, config['API_TOKEN'], args.kurs, args.trade, args.tax, args.save), args.csv,
+                   empty_message="Ingen tilbud er ændret")
+    elif args.command == 'import-logs':
+        import_text_logs(args.paths or sorted(glob.glob('logs/vehicle_export_log_*.txt')))
+    elif args.command == 'metrics':
+        report_metrics()
+    elif args.command == 'log':
+        for rendered_entry in render_quote_log(args.date):
+            print(rendered_entry, end='')
+    elif args.command == 'verify-tax':
+        with open(args.input, 'r', encoding='utf-8', newline='') as file:
+            verify_export_tax(csv.DictReader(file), config['API_TOKEN'], args.tolerance)
+    elif args.command == 'verify-co2':
+        with open(args.input, 'r', encoding='utf-8', newline='') as file:
+            verify_co2(csv.DictReader(file), config['API_TOKEN'], args.tolerance)
+    else:
+        start_update_check()
+        if args.server:
+            run_client(args.server.rstrip('/'), args.timings)
+        else:
+            main(args.timings)
+
+
 if __name__ == "__main__":
-    update_from_github()
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.no_cache:
+        set_cache_mode('off')
+    elif args.refresh:
+        set_cache_mode('refresh')
+    if args.profile:
+        run_profiled(lambda: run_command(args))
+    else:
+        run_command(args)
@@ -0,0 +1,542 @@
+"""Offline benchmark for ExportCalc_inkl_van.py.
+
+Kører hele tilbudsberegningen mod lokale stand-ins for Synsbasen, HubSpot,
+valutakurs-API'et og Google Sheets, så ydelsen kan måles uden at ramme de
+rigtige API'er eller ændre produktionsarkene.
+
+    python bench_exportcalc.py --plates 100 --workers 4 --latency sheets=0.2 --error-rate hubspot=0.05
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ExportCalc_inkl_van.py')
+
+# Standard svartider (sekunder) der ligner det vi ser fra kontoret
+DEFAULT_LATENCY = {'synsbasen': 0.15, 'hubspot': 0.2, 'fx': 0.1, 'sheets': 0.15}
+SERVICES = list(DEFAULT_LATENCY)
+
+BRANDS = [
+    ('Volkswagen', ['Golf', 'Passat', 'Transporter', 'Caddy']),
+    ('Toyota', ['Yaris', 'Corolla', 'Proace']),
+    ('Peugeot', ['208', '3008', 'Partner']),
+    ('Tesla', ['Model 3', 'Model Y'])
+]
+
+
+class FaultInjector:
+    # Forsinkelse og tilfældige fejl (429/503) for én tjeneste
+    def __init__(self, latency, error_rate, seed):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def before_call(self):
+        with self.lock:
+            self.calls += 1
+            fail = self.random.random() < self.error_rate
+            status = self.random.choice([429, 503]) if fail else None
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return status
+
+
+def synthetic_plate(index):
+    return f"BE{index:05d}"
+
+
+def synthetic_vehicle(registration_number):
+    seed = int(hashlib.sha256(registration_number.upper().encode()).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    brand, models = rng.choice(BRANDS)
+    kind = 'Varebil' if rng.random() < 0.2 else 'Personbil'
+    fuel_type = 'El' if brand == 'Tesla' else rng.choice(['Benzin', 'Diesel'])
+    fuel_efficiency = None if fuel_type == 'El' else round(rng.uniform(12, 28), 1)
+    registration_date = date.today() - timedelta(days=rng.randint(60, 14 * 365))
+    original_price = rng.randint(150, 700) * 1000
+    total_weight = rng.randint(1200, 3500)
+    appraisal_date = date.today() - timedelta(days=rng.randint(0, 90))
+    # Ca. hver tiende bil har ingen nypris, så den manuelle nypris-vej også køres
+    has_price = rng.random() >= 0.1
+    return {
+        'registration': registration_number.upper(),
+        'kind': kind,
+        'brand': brand,
+        'model': rng.choice(models),
+        'version': f"{rng.choice(['1.0', '1.5', '2.0'])} {rng.choice(['Comfort', 'Style', 'Van'])}",
+        'first_registration_date': registration_date.isoformat(),
+        'fuel_type': fuel_type,
+        'fuel_efficiency': fuel_efficiency,
+        'total_weight': total_weight,
+        'engine': {'fuel_type': fuel_type, 'fuel_efficiency': fuel_efficiency},
+        'weight': {'total_weight': total_weight},
+        'appraisals': {
+            'service_available': True,
+            'data': [{
+                'date': appraisal_date.isoformat(),
+                'original_price': original_price if has_price else None,
+                'value': int(original_price * rng.uniform(0.3, 0.9)),
+                'registration_tax': int(original_price * 0.4) if has_price else 0
+            }]
+        }
+    }
+
+
+def synthetic_mileage(registration_number):
+    rng = random.Random(registration_number.upper())
+    # Nogle plader findes ikke i HubSpot
+    return None if rng.random() < 0.15 else str(rng.randint(5000, 250000))
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, name, injector, route):
+        super().__init__(('127.0.0.1', 0), FakeApiHandler)
+        self.name = name
+        self.injector = injector
+        self.route = route
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 så klientens keep-alive faktisk genbruger forbindelserne
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_call('GET')
+
+    def do_POST(self):
+        self.handle_call('POST')
+
+    def handle_call(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        error_status = self.server.injector.before_call()
+        if error_status:
+            self.send_json(error_status, {'error': 'injiceret fejl'}, {'Retry-After': '0'})
+            return
+
+        status, payload = self.server.route(method, urlsplit(self.path), body)
+        self.send_json(status, payload)
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def synsbasen_route(method, url, body):
+    prefix = '/v1/vehicles/registration/'
+    if method == 'GET' and url.path.startswith(prefix):
+        return 200, {'data': synthetic_vehicle(url.path[len(prefix):])}
+    if method == 'POST' and url.path == '/v1/vehicles' and body.get('method') == 'SELECT':
+        registrations = body.get('query', {}).get('registration_in', [])
+        per_page = body.get('per_page', 20)
+        page = body.get('page', 1)
+        total_pages = max(1, -(-len(registrations) // per_page))
+        selected = registrations[(page - 1) * per_page:page * per_page]
+        return 200, {'data': [synthetic_vehicle(registration) for registration in selected],
+                     'meta': {'current_page': page, 'total_pages': total_pages}}
+    return 404, {'error': 'ukendt endpoint'}
+
+
+def hubspot_route(method, url, body):
+    if method != 'POST' or url.path != '/crm/v3/objects/deals/search':
+        return 404, {'error': 'ukendt endpoint'}
+    results = []
+    for group in body.get('filterGroups', []):
+        for search_filter in group.get('filters', []):
+            registration_number = search_filter['value']
+            mileage = synthetic_mileage(registration_number)
+            if mileage:
+                # En ældre deal for samme bil med lavere km; klienten skal vælge den nyeste
+                results.append({'properties': {
+                    'dealname': f"Vurdering {registration_number}",
+                    'kilometer': str(int(mileage) // 2),
+                    'createdate': '2023-06-01T10:00:00Z'
+                }})
+                results.append({'properties': {
+                    'dealname': f"Køb {registration_number}",
+                    'kilometer': mileage,
+                    'createdate': '2025-01-01T10:00:00Z'
+                }})
+    # Samme paginering som HubSpot: 'after' er et opaque offset
+    offset = int(body.get('after', 0))
+    limit = body.get('limit', 10)
+    page = {'total': len(results), 'results': results[offset:offset + limit]}
+    if offset + limit < len(results):
+        page['paging'] = {'next': {'after': str(offset + limit)}}
+    return 200, page
+
+
+def fx_route(method, url, body):
+    if method == 'GET' and url.path == '/latest':
+        return 200, {'rates': {'DKK': 7.4589}}
+    return 404, {'error': 'ukendt endpoint'}
+
+
+class FakeSheetsResponse(dict):
+    def __init__(self, status):
+        super().__init__({'retry-after': '0'})
+        self.status = status
+
+
+class FakeSheetsError(Exception):
+    # Ligner googleapiclient.errors.HttpError nok til at retry-logikken genkender den
+    def __init__(self, status):
+        super().__init__(f"Sheets svarede {status}")
+        self.resp = FakeSheetsResponse(status)
+
+
+class FakeSheetsRequest:
+    def __init__(self, injector, func):
+        self.injector = injector
+        self.func = func
+
+    def execute(self, http=None):
+        error_status = self.injector.before_call()
+        if error_status:
+            raise FakeSheetsError(error_status)
+        return self.func()
+
+
+class FakeSheets:
+    # Lokal udgave af KM- og afgiftsarket. Formlerne er syntetiske, men følger
+    # samme skriv-og-læs-mønster og de samme områder som de rigtige ark.
+    def __init__(self, module, injector):
+        self.module = module
+        self.injector = injector
+        self.cells = {}
+        self.lock = threading.Lock()
+
+    def values(self):
+        return self
+
+    def batchUpdate(self, spreadsheetId, body):
+        return FakeSheetsRequest(self.injector, lambda: self.write(spreadsheetId, body['data']))
+
+    def batchGet(self, spreadsheetId, ranges, valueRenderOption='FORMATTED_VALUE'):
+        if valueRenderOption == 'FORMULA':
+            return FakeSheetsRequest(self.injector, lambda: self.read_formulas(ranges))
+        return FakeSheetsRequest(self.injector, lambda: self.read(spreadsheetId, ranges))
+
+    def write(self, spreadsheet_id, data):
+        with self.lock:
+            for update in data:
+                if update['range'] == 'Ark1!E7:E9':
+                    for cell, row in zip(['Ark1!E7', 'Ark1!E8', 'Ark1!E9'], update['values']):
+                        self.cells[(spreadsheet_id, cell)] = row[0]
+                else:
+                    self.cells[(spreadsheet_id, update['range'])] = update['values'][0][0]
+        return {'totalUpdatedCells': len(data)}
+
+    def read(self, spreadsheet_id, ranges):
+        with self.lock:
+            return {'valueRanges': [
+                {'range': cell_range, 'values': self.evaluate(spreadsheet_id, cell_range)} for cell_range in ranges
+            ]}
+
+    def read_formulas(self, ranges):
+        # Formlerne ændrer sig aldrig i stand-in'et, så fingeraftrykket er konstant
+        return {'valueRanges': [{'range': cell_range, 'values': [['=E7-E8+E9']]} for cell_range in ranges]}
+
+    def cell(self, spreadsheet_id, cell_range, default=0):
+        return self.cells.get((spreadsheet_id, cell_range), default)
+
+    def evaluate(self, spreadsheet_id, cell_range):
+        module = self.module
+        if cell_range == 'Ark1!E19:I19':
+            handelspris = float(self.cell(spreadsheet_id, 'Ark1!E7'))
+            km_difference = float(self.cell(spreadsheet_id, 'Ark1!E9')) - float(self.cell(spreadsheet_id, 'Ark1!E8'))
+            base = max(1.0, handelspris / 1000 - km_difference * 0.0002)
+            return [[f"{base * factor:.1f}" for factor in (1.0, 0.95, 0.9, 0.85, 0.8)]]
+        if cell_range == 'Værktøj til CO2!C30':
+            fuel = module.CO2_FUEL_ALIASES.get(str(self.cell(spreadsheet_id, 'Værktøj til CO2!C27', '')).lower())
+            efficiency = str(self.cell(spreadsheet_id, 'Værktøj til CO2!C25', '0'))
+            if fuel is None or efficiency in ('None', '0', ''):
+                return [['0']]
+            norm = self.cell(spreadsheet_id, 'Værktøj til CO2!C26', 'WLTP')
+            return [[str(round(module.CO2_GRAMS_PER_LITER[norm][fuel] / float(efficiency)))]]
+        if cell_range == 'finalTax01':
+            tax = module.calculate_local_export_tax(
+                'Personbil', float(self.cell(spreadsheet_id, 'handelspris01')),
+                float(self.cell(spreadsheet_id, 'nypris01', 1)), float(self.cell(spreadsheet_id, 'co2km01')))
+            return [[f"{tax:.2f}"]]
+        if cell_range == 'Brugte Varebiler!G32':
+            heavy = self.cell(spreadsheet_id, 'Brugte Varebiler!L27', '') != 'Alle andre'
+            tax = module.calculate_local_export_tax(
+                'Varebil', float(self.cell(spreadsheet_id, 'Brugte Varebiler!L21')),
+                float(self.cell(spreadsheet_id, 'Brugte Varebiler!L22', 1)),
+                float(self.cell(spreadsheet_id, 'Brugte Varebiler!L23')), total_weight=3500 if heavy else 0)
+            return [[f"{tax:.2f}"]]
+        return []
+
+
+def parse_service_values(values, defaults):
+    # "sheets=0.2" -> {'sheets': 0.2}
+    result = dict(defaults)
+    for value in values or []:
+        name, _, number = value.partition('=')
+        if name not in SERVICES:
+            raise SystemExit(f"Ukendt tjeneste: {name} (vælg mellem {', '.join(SERVICES)})")
+        result[name] = float(number)
+    return result
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+
+def write_bench_config(work_dir, servers=None):
+    # Opdateringstjekket slås fra, så benchmarken aldrig rammer GitHub, og API'erne peges
+    # mod de lokale stand-ins når de er startet
+    with open(os.path.join(work_dir, 'config.txt'), 'w', encoding='utf-8') as file:
+        file.write("SERVICE_ACCOUNT_FILE=benchmark.json\n"
+                   "KM_SPREADSHEET_ID=bench-km\n"
+                   "TAX_SPREADSHEET_ID=bench-tax\n"
+                   "API_TOKEN=bench\n"
+                   "HUBSPOT_API_KEY=bench\n"
+                   "UPDATE_URL=\n")
+        for name, server in (servers or {}).items():
+            file.write(f"{name.upper()}_BASE_URL={server.base_url}\n")
+
+
+def load_exportcalc(work_dir):
+    # Scriptet læser config.txt ved import, så det indlæses fra en midlertidig mappe
+    write_bench_config(work_dir)
+    os.chdir(work_dir)
+    spec = importlib.util.spec_from_file_location('exportcalc_bench', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure_startup(runs):
+    # Tid fra processen startes til den første prompt vises. Kursopdateringen ved opstart går
+    # til en lokal stand-in, og en første kørsel der ikke tælles med fylder cachen med dagens
+    # kurs, så de målte kørsler starter som en almindelig dag hos brugeren.
+    timings = []
+    injectors = {name: FaultInjector(0.0, 0.0, 0) for name in SERVICES}
+    servers = start_fake_api_servers(injectors)
+    with tempfile.TemporaryDirectory(prefix='exportcalc-start-') as work_dir:
+        write_bench_config(work_dir, servers)
+        for run in range(runs + 1):
+            started = time.perf_counter()
+            process = subprocess.Popen([sys.executable, SCRIPT_PATH], cwd=work_dir, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            output = b''
+            while 'Indtast nummerplade'.encode('utf-8') not in output:
+                chunk = os.read(process.stdout.fileno(), 4096)
+                if not chunk:
+                    raise RuntimeError(f"Scriptet stoppede før første prompt: {output.decode('utf-8', 'replace')}")
+                output += chunk
+            if run:
+                timings.append(time.perf_counter() - started)
+            else:
+                # Kursen hentes i baggrunden; vent på den, så den når at blive gemt
+                deadline = time.monotonic() + 10
+                while not injectors['fx'].calls and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                time.sleep(0.2)
+            process.communicate(b'q\n', timeout=30)
+    for server in servers.values():
+        server.shutdown()
+    return timings
+
+
+def print_startup_report(timings):
+    values = sorted(timings)
+    print(f"Opstart til første prompt ({len(values)} kørsler): p50 {percentile(values, 0.5):.3f} s, "
+          f"min {values[0]:.3f} s, maks {values[-1]:.3f} s")
+
+
+def start_fake_api_servers(injectors):
+    servers = {
+        'synsbasen': FakeApiServer('synsbasen', injectors['synsbasen'], synsbasen_route),
+        'hubspot': FakeApiServer('hubspot', injectors['hubspot'], hubspot_route),
+        'fx': FakeApiServer('fx', injectors['fx'], fx_route)
+    }
+    for server in servers.values():
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return servers
+
+
+def start_fake_services(module, latency, error_rates, seed):
+    injectors = {name: FaultInjector(latency[name], error_rates[name], seed + index)
+                 for index, name in enumerate(SERVICES)}
+    servers = start_fake_api_servers(injectors)
+
+    # De rigtige grænser pr. host gælder også for de lokale stand-ins
+    module.HOST_RATE_LIMITS = {
+        urlsplit(servers['synsbasen'].base_url).netloc: module.HOST_RATE_LIMITS[urlsplit(module.SYNSBASEN_BASE_URL).netloc],
+        urlsplit(servers['hubspot'].base_url).netloc: module.HOST_RATE_LIMITS[urlsplit(module.HUBSPOT_BASE_URL).netloc]
+    }
+    module.SYNSBASEN_BASE_URL = servers['synsbasen'].base_url
+    module.HUBSPOT_BASE_URL = servers['hubspot'].base_url
+    module.FX_BASE_URL = servers['fx'].base_url
+    module.install_sheets_service(FakeSheets(module, injectors['sheets']))
+    return servers, injectors
+
+
+def timed_quote(module, index):
+    registration_number = synthetic_plate(index)
+    rng = random.Random(index)
+    metrics = module.start_quote_metrics()
+    started = time.perf_counter()
+    try:
+        module.quote_vehicle(
+            registration_number,
+            handelspris_input=rng.randint(50, 400) * 1000,
+            norm_km_input=15000,
+            eur_price=rng.randint(5, 40) * 1000,
+            api_token='bench',
+            hubspot_api_key='bench',
+            # Halvdelen henter kilometertal fra HubSpot; plader uden handel i HubSpot får det indtastet
+            current_km_input=(None if index % 2 and synthetic_mileage(registration_number)
+                              else float(rng.randint(5000, 200000))),
+            manual_price=rng.randint(150, 700) * 1000
+        )
+        error = None
+    except Exception as e:
+        error = str(e)
+    return time.perf_counter() - started, error, module.summarize_quote_metrics(metrics)
+
+
+def run_pass(module, plates, workers):
+    module.reset_api_call_counts()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda index: timed_quote(module, index), range(1, plates + 1)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [seconds for seconds, error, _ in results if error is None]
+    errors = [error for _, error, _ in results if error is not None]
+    stage_samples = {}
+    for _, _, summary in results:
+        for stage, values in summary.items():
+            stage_samples.setdefault(stage, []).append(values['seconds'])
+
+    api_calls = module.get_api_call_counts()
+    return {
+        'plates': plates,
+        'workers': workers,
+        'elapsed': elapsed,
+        'throughput': plates / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'api_calls': api_calls,
+        'api_calls_per_quote': sum(api_calls.values()) / plates if plates else 0.0,
+        'stages': {stage: {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95)}
+                   for stage, values in stage_samples.items()}
+    }
+
+
+def print_report(pass_number, report):
+    print(f"\n=== Gennemløb {pass_number}: {report['plates']} plader, {report['workers']} workers ===")
+    print(f"Tid: {report['elapsed']:.2f} s, gennemløb: {report['throughput']:.2f} tilbud/s")
+    print(f"Latens pr. tilbud: p50 {report['p50']:.3f} s, p95 {report['p95']:.3f} s, p99 {report['p99']:.3f} s")
+    print(f"Fejl: {report['errors']}")
+    for error in report['error_samples']:
+        print(f"  - {error}")
+    calls = ", ".join(f"{name}: {count}" for name, count in sorted(report['api_calls'].items()))
+    print(f"API-kald: {sum(report['api_calls'].values())} ({calls}), {report['api_calls_per_quote']:.2f} pr. tilbud")
+    print(f"{'Trin':<16}{'p50 (s)':>10}{'p95 (s)':>10}")
+    for stage, values in sorted(report['stages'].items()):
+        print(f"{stage:<16}{values['p50']:>10.3f}{values['p95']:>10.3f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark af tilbudsberegningen")
+    parser.add_argument('--plates', type=int, default=50, help="Antal syntetiske nummerplader")
+    parser.add_argument('--workers', type=int, default=1, help="Antal samtidige tilbud")
+    parser.add_argument('--passes', type=int, default=1, help="Antal gennemløb (fx 2 for at måle med varm cache)")
+    parser.add_argument('--latency', action='append', metavar='TJENESTE=SEK',
+                        help=f"Svartid pr. kald, fx sheets=0.2 (standard {DEFAULT_LATENCY})")
+    parser.add_argument('--error-rate', action='append', metavar='TJENESTE=ANDEL',
+                        help="Andel kald der fejler med 429/503, fx hubspot=0.05")
+    parser.add_argument('--cache', action='store_true', help="Brug den lokale cache (tom ved start)")
+    parser.add_argument('--seed', type=int, default=1, help="Seed til fejlinjektion")
+    parser.add_argument('--json', help="Gem resultatet som JSON til sammenligning mellem kørsler")
+    parser.add_argument('--startup', type=int, metavar='ANTAL',
+                        help="Mål i stedet tiden fra start til første prompt over ANTAL kørsler")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    latency = parse_service_values(args.latency, DEFAULT_LATENCY)
+    error_rates = parse_service_values(args.error_rate, {name: 0.0 for name in SERVICES})
+
+    if args.startup:
+        timings = measure_startup(args.startup)
+        print_startup_report(timings)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as file:
+                json.dump({'settings': vars(args), 'startup': timings}, file, indent=2)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='exportcalc-bench-') as work_dir:
+        original_dir = os.getcwd()
+        try:
+            module = load_exportcalc(work_dir)
+            module.set_cache_mode('normal' if args.cache else 'off')
+            servers, injectors = start_fake_services(module, latency, error_rates, args.seed)
+
+            reports = []
+            for pass_number in range(1, args.passes + 1):
+                report = run_pass(module, args.plates, args.workers)
+                print_report(pass_number, report)
+                reports.append(report)
+
+            print("\nInjicerede fejl: " + ", ".join(
+                f"{name}: {injector.errors}/{injector.calls}" for name, injector in injectors.items()))
+            for server in servers.values():
+                server.shutdown()
+        finally:
+            os.chdir(original_dir)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'settings': vars(args), 'latency': latency, 'error_rates': error_rates,
+                       'passes': reports}, file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())